@@ -0,0 +1,317 @@
+# for the asyncio sender
+import asyncio
+import json
+import ssl
+from urllib.parse import quote, urlsplit
+
+from metrics import API_SECONDS, RATE_LIMITED, SEND_QUEUE, count_send
+from ratelimit import QuotaLimiter, QUOTA_COSTS, is_rate_error, retry_after
+from sender import SenderPool, envelope_size, recipient_count
+
+
+_API_SEND = API_SECONDS.labels(method='messages.send')
+
+
+class Response(dict):
+    '''
+    the headers of an http response (lower case names),
+    plus its status, looking enough like an httplib2 response
+    for ratelimit.is_rate_error and retry_after
+    '''
+
+    def __init__(self, status, headers):
+        super().__init__(headers)
+        self.status = status
+
+
+class AsyncHttpError(Exception):
+    '''
+    gmail answered with an error status.
+    has the same resp and content attributes as
+    googleapiclient's HttpError
+    '''
+
+    def __init__(self, resp:Response, content:bytes):
+        self.resp = resp
+        self.content = content
+        super().__init__(f'<HttpError {resp.status} "{content[:200].decode("utf-8", "replace")}">')
+
+
+class Connection:
+    '''
+    A single keep-alive http/1.1 connection
+    '''
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.open = True
+
+    @classmethod
+    async def connect(cls, host, port, ssl_context, timeout):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=ssl_context,
+                                    server_hostname=host if ssl_context else None),
+            timeout)
+        return cls(reader, writer)
+
+    async def request(self, method, target, headers, body:bytes):
+        '''
+        makes a request and reads the whole response
+        :return: (Response, body bytes)
+        '''
+        lines = [f'{method} {target} HTTP/1.1']
+        lines.extend(f'{name}: {value}' for name, value in headers.items())
+        lines.append(f'Content-Length: {len(body)}')
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError('connection closed by server')
+        status = int(status_line.split(None, 2)[1])
+
+        response_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+        resp = Response(status, response_headers)
+
+        if resp.get('transfer-encoding', '').lower() == 'chunked':
+            content = await self._read_chunked()
+        else:
+            content = await self.reader.readexactly(int(resp.get('content-length', 0)))
+
+        if resp.get('connection', '').lower() == 'close':
+            self.close()
+        return resp, content
+
+    async def _read_chunked(self):
+        chunks = []
+        while True:
+            size = int((await self.reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                # skip any trailers
+                while (await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks)
+            chunks.append(await self.reader.readexactly(size))
+            await self.reader.readline()
+
+    def close(self):
+        if self.open:
+            self.open = False
+            self.writer.close()
+
+
+class AsyncEmailer:
+    '''
+    Sends messages with asyncio rather than threads.
+
+    A pool of keep-alive connections is shared by up to
+    concurrency sends at once, all on one thread. Each send
+    reuses an idle connection if there is one and opens a
+    new one (up to connections of them) if not.
+
+    Talks to the gmail rest api directly, so it only needs
+    an access token (e.g. Authenicator.access_token)
+    '''
+
+    BASE_URL = 'https://gmail.googleapis.com'
+
+    # how many times to retry a message gmail rate limited
+    MAX_RETRIES = 5
+
+    def __init__(self, token, base_url:str=BASE_URL, connections:int=100,
+                 concurrency:int=200, limiter:QuotaLimiter=None, timeout:float=60,
+                 max_queued_bytes:int=SenderPool.MAX_QUEUED_BYTES, pacer=None):
+        '''
+        :param token: callable that returns the current access token
+        :param base_url: where the gmail api is (e.g. a fake server for testing)
+        :param connections: most connections to have open
+        :param concurrency: most sends in flight at once
+        :param limiter: quota limiter for the account
+        :param timeout: seconds to give each request
+        :param max_queued_bytes: most bytes of messages in flight at once,
+                                 so big messages (e.g. with attachments)
+                                 don't pile up in memory
+        :param pacer: what keeps the sends under the account's daily limit,
+                      anything with a wait(count) like scheduler.DailyPacer's.
+                      each envelope waits for it (on another thread, so the
+                      other sends carry on), and sending stops early if it
+                      returns False
+        '''
+        self.token = token
+        url = urlsplit(base_url)
+        self.host = url.hostname
+        self.https = url.scheme == 'https'
+        self.port = url.port or (443 if self.https else 80)
+        # the port only goes in the host header if it isn't the usual one
+        self.host_header = (self.host if self.port == (443 if self.https else 80)
+                            else f'{self.host}:{self.port}')
+        self.path_prefix = url.path.rstrip('/')
+        self.max_connections = max(1, connections)
+        self.concurrency = max(1, concurrency)
+        self.limiter = limiter
+        self.timeout = timeout
+        self.max_queued_bytes = max_queued_bytes
+        self.pacer = pacer
+        self._ssl = ssl.create_default_context() if self.https else None
+        self._idle = []
+        self._slots = None
+
+    async def _connection(self, reuse=True):
+        '''
+        an idle connection, or a new one
+        (waits for one to free up if there are too many open)
+        :return: (connection, whether it was reused)
+        '''
+        await self._slots.acquire()
+        while reuse and self._idle:
+            connection = self._idle.pop()
+            if connection.open and not connection.reader.at_eof():
+                return connection, True
+            connection.close()
+        try:
+            connection = await Connection.connect(self.host, self.port, self._ssl, self.timeout)
+        except BaseException:
+            self._slots.release()
+            raise
+        return connection, False
+
+    def _release(self, connection, reusable):
+        if reusable and connection.open:
+            self._idle.append(connection)
+        else:
+            connection.close()
+        self._slots.release()
+
+    async def _request(self, method, path, payload):
+        '''
+        makes one api request on a pooled connection
+        :return: (Response, body bytes)
+        '''
+        body = json.dumps(payload).encode('utf-8')
+        headers = {
+            'Host': self.host_header,
+            'Authorization': f'Bearer {self.token()}',
+            'Content-Type': 'application/json',
+            'Accept-Encoding': 'identity',
+            }
+        reuse = True
+        while True:
+            connection, reused = await self._connection(reuse)
+            reusable = False
+            try:
+                result = await asyncio.wait_for(
+                    connection.request(method, self.path_prefix + path, headers, body),
+                    self.timeout)
+                reusable = True
+                return result
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # the server may have closed an idle connection just as
+                # it was picked up, so give it one go on a new connection
+                if not reused:
+                    raise
+                reuse = False
+            finally:
+                self._release(connection, reusable)
+
+    async def send(self, envelope):
+        '''
+        sends the envelope, retrying if gmail rate limits it
+        :return: (True, sent_message) or (False, error)
+        '''
+        path = '/gmail/v1/users/{}/messages/send'.format(quote(envelope.sender, safe=''))
+        for attempt in range(self.MAX_RETRIES + 1):
+            if self.limiter is not None:
+                await asyncio.sleep(self.limiter.reserve(QUOTA_COSTS['messages.send']))
+            try:
+                with _API_SEND.time():
+                    resp, content = await self._request('POST', path, envelope.message)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+                count_send(e)
+                return False, e
+            if resp.status < 300:
+                if self.limiter is not None:
+                    self.limiter.success()
+                try:
+                    sent_msg = json.loads(content.decode('utf-8') or '{}')
+                except ValueError as e:
+                    # e.g. a truncated body, which fails this envelope, not the campaign
+                    count_send(e)
+                    return False, e
+                count_send()
+                return True, sent_msg
+            e = AsyncHttpError(resp, content)
+            if attempt < self.MAX_RETRIES and self.limiter is not None and is_rate_error(e):
+                RATE_LIMITED.inc()
+                self.limiter.backoff(retry_after(e))
+                continue
+            count_send(e)
+            return False, e
+
+    async def send_all(self, envelopes, callback):
+        '''
+        sends every envelope, keeping up to concurrency of them in flight
+        :param envelopes: iterable of Envelope, read lazily
+        :param callback: called as callback(envelope, sent, sent_msg_or_error)
+        :return: (number sent, number failed)
+        '''
+        self._slots = asyncio.Semaphore(self.max_connections)
+        in_flight = asyncio.Semaphore(self.concurrency)
+        queued = asyncio.Condition()
+        queued_bytes = 0
+        counts = [0, 0]
+        tasks = set()
+
+        async def _send(envelope, size):
+            nonlocal queued_bytes
+            try:
+                sent, result = await self.send(envelope)
+                counts[0 if sent else 1] += 1
+                callback(envelope, sent, result)
+            finally:
+                SEND_QUEUE.dec()
+                async with queued:
+                    queued_bytes -= size
+                    queued.notify_all()
+                in_flight.release()
+
+        try:
+            for envelope in envelopes:
+                if self.pacer is not None and not await asyncio.get_running_loop().run_in_executor(
+                        None, self.pacer.wait, recipient_count(envelope)):
+                    break
+                size = envelope_size(envelope)
+                await in_flight.acquire()
+                async with queued:
+                    await queued.wait_for(lambda: queued_bytes == 0
+                                          or queued_bytes + size <= self.max_queued_bytes)
+                    queued_bytes += size
+                SEND_QUEUE.inc()
+                task = asyncio.ensure_future(_send(envelope, size))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            self.close()
+        return counts[0], counts[1]
+
+    def close(self):
+        for connection in self._idle:
+            connection.close()
+        self._idle = []
+
+    def run(self, envelopes, callback):
+        '''
+        sends every envelope on a new event loop, blocking until
+        they are all done. this is the same as SenderPool.run,
+        so it can be dropped in for it (e.g. on a gui worker thread)
+        :return: (number sent, number failed)
+        '''
+        return asyncio.run(self.send_all(envelopes, callback))
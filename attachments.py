@@ -0,0 +1,82 @@
+# for the attachments
+import base64
+import mimetypes
+import mmap
+from email.mime.base import MIMEBase
+from os import path
+
+
+class Attachment:
+    '''
+    A file attached to a message.
+
+    The file is memory mapped and base64 encoded the first
+    time its mime part is needed, and that one encoded part
+    is shared by the message to every recipient, so the
+    file is never read or encoded again
+    '''
+
+    def __init__(self, file_path, filename:str=None, content_type:str=None):
+        '''
+        :param file_path: the file to attach
+        :param filename: what to call it in the message
+                         (the file's name if not given)
+        :param content_type: e.g. 'application/pdf'
+                             (guessed from the filename if not given)
+        '''
+        self.path = file_path
+        self.filename = filename or path.basename(file_path)
+        self.content_type = (content_type or mimetypes.guess_type(self.filename)[0]
+                             or 'application/octet-stream')
+        self._part = None
+
+    def __repr__(self):
+        return f'Attachment({self.path!r})'
+
+    def __getstate__(self):
+        # the encoded part can be many megabytes, so it is left
+        # out when pickled (e.g. to send to another process)
+        state = self.__dict__.copy()
+        state['_part'] = None
+        return state
+
+    @property
+    def size(self):
+        '''
+        the size of the file, in bytes
+        '''
+        return path.getsize(self.path)
+
+    def part(self):
+        '''
+        the bytes of the whole mime part (headers and
+        base64 encoded file), encoded the first time
+        '''
+        if self._part is None:
+            self._part = self._headers() + self._encode()
+        return self._part
+
+    def _headers(self):
+        '''
+        the part's headers and the blank line after them,
+        written by the email package so the filename is
+        encoded properly
+        '''
+        maintype, _, subtype = self.content_type.partition('/')
+        part = MIMEBase(maintype, subtype or 'octet-stream')
+        del part['MIME-Version']
+        part['Content-Transfer-Encoding'] = 'base64'
+        part.add_header('Content-Disposition', 'attachment', filename=self.filename)
+        return part.as_bytes().split(b'\n\n', 1)[0] + b'\n\n'
+
+    def _encode(self):
+        '''
+        base64 encodes the file straight from the page cache,
+        without reading it into memory first
+        '''
+        with open(self.path, 'rb') as f:
+            # an empty file can't be mapped
+            if path.getsize(self.path) == 0:
+                return b''
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return base64.encodebytes(data)
@@ -0,0 +1,267 @@
+#-*- coding: utf-8 -*-
+'''
+Benchmarks for rendering messages, the per recipient hot path.
+
+Times Message.create, Message.recreate and Message.envelope
+(with merge fields) over a range of body sizes, plain and
+html bodies, ascii and non-ascii text and recipient counts,
+and measures the memory each run allocates with tracemalloc.
+
+The results are saved as json along with the git commit they
+were taken at, so two commits can be compared. e.g.
+
+    python benchmarks/bench_render.py --output before.json
+    (make some changes)
+    python benchmarks/bench_render.py --output after.json --compare before.json
+
+Only needs the standard library (the google libraries
+are not imported to render messages)
+'''
+
+import argparse
+import gc
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from itertools import product
+from os import path
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from gmail import Message
+
+
+# what is benchmarked. every combination is run
+MODES = ('create', 'recreate', 'merge')
+BODY_SIZES = (1_000, 10_000, 100_000)
+BODY_TYPES = ('plain', 'html')
+CHARSETS = ('ascii', 'non-ascii')
+RECIPIENT_COUNTS = (1, 100, 1_000)
+
+# a smaller set for a quick check
+QUICK_BODY_SIZES = (1_000, 100_000)
+QUICK_RECIPIENT_COUNTS = (100,)
+
+SENDER = 'me'
+SUBJECT = 'The monthly newsletter'
+MERGE_SUBJECT = 'The monthly newsletter for {first_name}'
+
+WORDS = {
+    'ascii': 'the quick brown fox jumps over the lazy dog ',
+    'non-ascii': 'le cœur déçu mais l’âme plutôt naïve, Zoë ✓ 日本語 ',
+}
+
+
+def make_body(size:int, body_type:str, charset:str, merge:bool=False):
+    '''
+    about :size: characters of body text
+    (html bodies get a paragraph every few hundred characters)
+    '''
+    text = (WORDS[charset] * (size // len(WORDS[charset]) + 1))[:size]
+    if merge:
+        text = 'Dear {first_name},\n' + text
+    if body_type == 'html':
+        paragraphs = (text[i:i + 400] for i in range(0, len(text), 400))
+        text = '<html><body>{}</body></html>'.format(
+            ''.join('<p>{}</p>'.format(p) for p in paragraphs))
+    return text
+
+
+def make_recipients(count:int):
+    '''
+    (address, merge fields) for :count: recipients
+    '''
+    return [('person{}@example.com'.format(i), {'first_name': 'Person {}'.format(i)})
+            for i in range(count)]
+
+
+def make_run(mode:str, body:str, body_type:str, recipients):
+    '''
+    the function being timed, which renders
+    a message for every recipient
+    '''
+    if mode == 'create':
+        # a fresh message for everyone, i.e. nothing reused
+        def run():
+            for address, _ in recipients:
+                Message().create(address, SENDER, SUBJECT, body, body_type)
+
+    elif mode == 'recreate':
+        # one message, re-addressed for everyone
+        message = Message()
+        message.create(recipients[0][0], SENDER, SUBJECT, body, body_type)
+
+        def run():
+            for address, _ in recipients:
+                message.to = address
+                message.recreate()
+
+    elif mode == 'merge':
+        # one message with merge fields filled in for everyone
+        message = Message()
+        message.create(recipients[0][0], SENDER, MERGE_SUBJECT, body, body_type)
+
+        def run():
+            for address, fields in recipients:
+                message.envelope(address, fields)
+
+    else:
+        raise ValueError(f'Unknown mode "{mode}"')
+    return run
+
+
+def time_run(run, repeat:int):
+    '''
+    :return: the quickest of :repeat: runs, in seconds
+    '''
+    run()  # warm up
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def measure_allocations(run):
+    '''
+    traces the memory allocated by one run
+    :return: (peak bytes over the start, bytes still held after)
+    '''
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        run()
+        after, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak - before, after - before
+
+
+def benchmark(mode, body_size, body_type, charset, count, repeat):
+    body = make_body(body_size, body_type, charset, merge=(mode == 'merge'))
+    recipients = make_recipients(count)
+    run = make_run(mode, body, body_type, recipients)
+
+    seconds = time_run(run, repeat)
+    peak, retained = measure_allocations(run)
+
+    message = Message()
+    message.create(recipients[0][0], SENDER, SUBJECT, body, body_type)
+
+    return {
+        'mode': mode,
+        'body_size': body_size,
+        'body_type': body_type,
+        'charset': charset,
+        'recipients': count,
+        'raw_bytes': len(message.message['raw']),
+        'seconds': seconds,
+        'per_second': count / seconds if seconds else None,
+        'us_per_message': 1e6 * seconds / count,
+        'peak_bytes': peak,
+        'peak_bytes_per_message': peak / count,
+        'retained_bytes': retained,
+        }
+
+
+def result_key(result):
+    return (result['mode'], result['body_size'], result['body_type'],
+            result['charset'], result['recipients'])
+
+
+def git_commit():
+    '''
+    the commit being benchmarked (with a + if
+    there are uncommitted changes), or None
+    '''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, check=True,
+                                capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                               cwd=ROOT, check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('+' if dirty else '')
+
+
+def compare(old, new):
+    '''
+    prints how each benchmark changed between two sets of results
+    '''
+    previous = {result_key(r): r for r in old['results']}
+    print('\ncompared to {} (taken {})'.format(old.get('commit'), old.get('timestamp')))
+    print('{:<10}{:>8}{:>7}{:>11}{:>7}{:>14}{:>14}{:>9}{:>12}'.format(
+        'mode', 'body', 'type', 'charset', 'count', 'before/s', 'after/s', 'speed', 'peak mem'))
+    for result in new['results']:
+        before = previous.get(result_key(result))
+        if before is None:
+            continue
+        speed = result['per_second'] / before['per_second']
+        if before['peak_bytes']:
+            memory = '{:+.0%}'.format(result['peak_bytes'] / before['peak_bytes'] - 1)
+        else:
+            memory = '-'
+        print('{:<10}{:>8}{:>7}{:>11}{:>7}{:>14,.0f}{:>14,.0f}{:>8.2f}x{:>12}'.format(
+            *result_key(result), before['per_second'], result['per_second'], speed, memory))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark rendering messages for each recipient.')
+    parser.add_argument('--output', default=None,
+                        help='json file to save the results to')
+    parser.add_argument('--compare', default=None,
+                        help='json file of earlier results to compare against')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timed runs of each benchmark, the quickest is kept (default: %(default)s)')
+    parser.add_argument('--quick', action='store_true',
+                        help='run fewer body sizes and recipient counts')
+    parser.add_argument('--mode', choices=MODES, action='append',
+                        help='only run this mode (may be given more than once)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    body_sizes = QUICK_BODY_SIZES if args.quick else BODY_SIZES
+    counts = QUICK_RECIPIENT_COUNTS if args.quick else RECIPIENT_COUNTS
+
+    results = []
+    print('{:<10}{:>8}{:>7}{:>11}{:>7}{:>14}{:>12}{:>14}'.format(
+        'mode', 'body', 'type', 'charset', 'count', 'messages/s', 'us/message', 'peak KiB'))
+    for case in product(args.mode or MODES, body_sizes, BODY_TYPES, CHARSETS, counts):
+        result = benchmark(*case, repeat=args.repeat)
+        results.append(result)
+        print('{:<10}{:>8}{:>7}{:>11}{:>7}{:>14,.0f}{:>12.1f}{:>14,.1f}'.format(
+            *case, result['per_second'], result['us_per_message'], result['peak_bytes'] / 1024))
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'results': results,
+        }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'\nsaved to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,464 @@
+#-*- coding: utf-8 -*-
+'''
+A local stand-in for the parts of the gmail api the app uses,
+for load testing without sending real email.
+
+It serves users.messages.send, users.getProfile, batch
+requests, an oauth token endpoint and a discovery document
+for the google client library, and can be made to
+be slow, fail, rate limit and expire access tokens. Nothing
+is kept per message, so it can run for as long as needed.
+
+Run it on its own with e.g.
+
+    python benchmarks/fake_gmail.py --port 8080 --latency 0.05 --quota 250
+
+or start a FakeGmail in process (see load_test.py)
+'''
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from urllib.parse import parse_qs
+from uuid import uuid4
+
+
+# what gmail charges for each method, in quota units
+SEND_COST = 100
+PROFILE_COST = 1
+
+SEND_PATH = re.compile(r'/gmail/v1/users/([^/]+)/messages/send$')
+PROFILE_PATH = re.compile(r'/gmail/v1/users/([^/]+)/profile$')
+DISCOVERY_PATH = '/discovery/v1/apis/gmail/v1/rest'
+
+
+def discovery_document(url:str):
+    '''
+    just enough of gmail's discovery document for the google client
+    library to build a service that sends through the server at url
+    '''
+    user_id = {'type': 'string', 'required': True, 'location': 'path'}
+    return {
+        'kind': 'discovery#restDescription',
+        'discoveryVersion': 'v1',
+        'id': 'gmail:v1',
+        'name': 'gmail',
+        'version': 'v1',
+        'protocol': 'rest',
+        'rootUrl': url + '/',
+        'servicePath': '',
+        'baseUrl': url + '/',
+        'batchPath': 'batch/gmail/v1',
+        'parameters': {},
+        'schemas': {
+            'Message': {'id': 'Message', 'type': 'object',
+                        'properties': {'id': {'type': 'string'}, 'raw': {'type': 'string'}}},
+            'Profile': {'id': 'Profile', 'type': 'object',
+                        'properties': {'emailAddress': {'type': 'string'}}},
+            },
+        'resources': {'users': {
+            'methods': {'getProfile': {
+                'id': 'gmail.users.getProfile',
+                'path': 'gmail/v1/users/{userId}/profile',
+                'httpMethod': 'GET',
+                'parameters': {'userId': user_id},
+                'parameterOrder': ['userId'],
+                'response': {'$ref': 'Profile'},
+                }},
+            'resources': {'messages': {'methods': {'send': {
+                'id': 'gmail.users.messages.send',
+                'path': 'gmail/v1/users/{userId}/messages/send',
+                'httpMethod': 'POST',
+                'parameters': {'userId': user_id},
+                'parameterOrder': ['userId'],
+                'request': {'$ref': 'Message'},
+                'response': {'$ref': 'Message'},
+                }}}},
+            }},
+        }
+
+
+def error_body(code:int, message:str, reason:str, status:str):
+    '''
+    the json body of an error, laid out like google's
+    '''
+    return {'error': {
+        'code': code,
+        'message': message,
+        'errors': [{'message': message, 'domain': 'global', 'reason': reason}],
+        'status': status,
+        }}
+
+
+class FakeGmail(ThreadingHTTPServer):
+    '''
+    The fake gmail server.
+
+    Each request waits latency seconds (plus up to jitter more),
+    then fails with a 500 error_rate of the time and a 429
+    rate_limit_rate of the time. Calls past quota units a second
+    (per account) are rate limited too, like gmail's per user limit.
+    Access tokens come from POST /token and stop working after
+    token_lifetime seconds. Each refresh token is its own account,
+    which can send daily_limit messages before it is refused
+    '''
+
+    daemon_threads = True
+    # plenty of room for every connection a load test opens at once
+    request_queue_size = 1024
+
+    def __init__(self, address=('127.0.0.1', 0), latency:float=0.0, jitter:float=0.0,
+                 error_rate:float=0.0, rate_limit_rate:float=0.0, quota:float=None,
+                 token_lifetime:float=None, daily_limit:int=None,
+                 email_address:str='loadtest@example.com', seed:int=None):
+        '''
+        :param address: (host, port) to listen on. port 0 picks a free one
+        :param latency: seconds every request takes
+        :param jitter: most extra seconds a request takes, picked at random
+        :param error_rate: fraction of calls that fail with a 500
+        :param rate_limit_rate: fraction of calls rate limited (429) at random
+        :param quota: quota units a second allowed, None for no limit
+        :param token_lifetime: seconds an access token works for,
+                               None to take any token at all
+        :param daily_limit: messages each account can send, None for no limit
+        :param email_address: of the signed in user
+        :param seed: for the random failures
+        '''
+        super().__init__(address, FakeGmailHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.quota = quota
+        self.token_lifetime = token_lifetime
+        self.daily_limit = daily_limit
+        self.email_address = email_address
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = {}
+        self._sent_by = {}
+        self._token_ids = count(1)
+        self._message_ids = count(1)
+        # each account's quota bucket, as (units, when it was last filled)
+        self._buckets = {}
+        self._thread = None
+        self.counts = dict.fromkeys(
+            ('requests', 'batches', 'sent', 'bytes', 'errors',
+             'rate_limited', 'daily_limited', 'unauthorized', 'tokens'), 0)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        '''
+        serves requests in a background thread
+        '''
+        self._thread = threading.Thread(target=self.serve_forever, name='FakeGmail', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def stats(self):
+        '''
+        a copy of the counts of everything served
+        '''
+        with self._lock:
+            return dict(self.counts)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.counts[name] += amount
+
+    def delay(self):
+        '''
+        seconds the next request should take
+        '''
+        if not self.jitter:
+            return self.latency
+        with self._lock:
+            return self.latency + self._random.uniform(0, self.jitter)
+
+    def issue_token(self, account:str):
+        '''
+        a new access token for the account
+        :return: (token, seconds it lasts)
+        '''
+        lifetime = self.token_lifetime or 3600
+        with self._lock:
+            token = 'fake-token-{}'.format(next(self._token_ids))
+            now = time.monotonic()
+            # forget the tokens that have expired
+            self._tokens = {t: (expiry, a) for t, (expiry, a) in self._tokens.items()
+                            if expiry > now}
+            self._tokens[token] = (now + lifetime, account)
+            self.counts['tokens'] += 1
+        return token, lifetime
+
+    def account(self, header):
+        '''
+        the account the Authorization header's token is for,
+        or None if it doesn't have a working one
+        '''
+        token = (header or '').partition('Bearer ')[2].strip()
+        with self._lock:
+            expiry, account = self._tokens.get(token, (0, None))
+        if not self.token_lifetime:
+            # any token works, and is its own account if it wasn't issued here
+            return token if account is None else account
+        return account if expiry > time.monotonic() else None
+
+    def _take_quota(self, units, account):
+        '''
+        takes units from the account's quota bucket
+        :return: 0 if there was enough, otherwise seconds until there is
+        '''
+        if not self.quota:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            bucket, last = self._buckets.get(account, (self.quota, now))
+            bucket = min(self.quota, bucket + (now - last) * self.quota)
+            wait = 0
+            if bucket < units:
+                wait = (units - bucket) / self.quota
+            else:
+                bucket -= units
+            self._buckets[account] = (bucket, now)
+            return wait
+
+    def call(self, method, path, body, account):
+        '''
+        answers a single api call (on its own or part of a batch)
+        :return: (status, headers, json body)
+        '''
+        send = SEND_PATH.match(path)
+        profile = PROFILE_PATH.match(path)
+        if send and method == 'POST':
+            cost = SEND_COST
+        elif profile and method == 'GET':
+            cost = PROFILE_COST
+        else:
+            return 404, {}, error_body(404, 'Not Found', 'notFound', 'NOT_FOUND')
+
+        with self._lock:
+            roll = self._random.random()
+        if roll < self.error_rate:
+            self._count('errors')
+            return 500, {}, error_body(500, 'Backend Error', 'backendError', 'INTERNAL')
+        wait = self._take_quota(cost, account)
+        if wait or roll < self.error_rate + self.rate_limit_rate:
+            self._count('rate_limited')
+            headers = {'Retry-After': str(max(1, round(wait)))} if wait else {}
+            return 429, headers, error_body(429, 'User-rate limit exceeded',
+                                            'rateLimitExceeded', 'RESOURCE_EXHAUSTED')
+
+        if profile:
+            return 200, {}, {'emailAddress': self.email_address, 'messagesTotal': 0,
+                             'threadsTotal': 0, 'historyId': '1'}
+
+        if self.daily_limit is not None:
+            with self._lock:
+                sent = self._sent_by.get(account, 0)
+                if sent < self.daily_limit:
+                    self._sent_by[account] = sent + 1
+            if sent >= self.daily_limit:
+                self._count('daily_limited')
+                return 403, {}, error_body(403, 'Daily Limit Exceeded', 'dailyLimitExceeded',
+                                           'PERMISSION_DENIED')
+
+        try:
+            raw = json.loads(body or b'{}')['raw']
+        except (ValueError, KeyError, TypeError):
+            return 400, {}, error_body(400, "'raw' RFC822 payload message string or "
+                                       "uploading message via /upload/* URL required",
+                                       'invalidArgument', 'INVALID_ARGUMENT')
+        with self._lock:
+            message_id = '{:016x}'.format(next(self._message_ids))
+            self.counts['sent'] += 1
+            self.counts['bytes'] += len(raw)
+        return 200, {}, {'id': message_id, 'threadId': message_id, 'labelIds': ['SENT']}
+
+
+class FakeGmailHandler(BaseHTTPRequestHandler):
+    '''
+    Routes each http request to the FakeGmail server
+    '''
+
+    # keep-alive, like google's servers
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _reply(self, status, headers, body, content_type='application/json; charset=UTF-8'):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def _handle(self, method):
+        server = self.server
+        server._count('requests')
+        body = self._body()
+        path = self.path.partition('?')[0]
+
+        if path == '/token' and method == 'POST':
+            self._token(body)
+            return
+        if path == DISCOVERY_PATH and method == 'GET':
+            # pointed at wherever the client reached the server
+            host = self.headers.get('Host')
+            self._reply(200, {}, discovery_document(f'http://{host}' if host else server.url))
+            return
+
+        time.sleep(server.delay())
+
+        account = server.account(self.headers.get('Authorization'))
+        if account is None:
+            server._count('unauthorized')
+            self._reply(401, {'WWW-Authenticate': 'Bearer realm="https://accounts.google.com/"'},
+                        error_body(401, 'Request had invalid authentication credentials.',
+                                   'authError', 'UNAUTHENTICATED'))
+        elif path.startswith('/batch'):
+            server._count('batches')
+            self._batch(body, account)
+        else:
+            self._reply(*server.call(method, path, body, account))
+
+    def _token(self, body):
+        '''
+        the oauth token endpoint, which hands
+        out a new access token for any refresh token
+        '''
+        form = parse_qs(body.decode('utf-8'))
+        if form.get('grant_type') != ['refresh_token']:
+            self._reply(400, {}, {'error': 'unsupported_grant_type'})
+            return
+        token, lifetime = self.server.issue_token(form.get('refresh_token', [''])[0])
+        self._reply(200, {}, {'access_token': token, 'expires_in': int(lifetime),
+                              'token_type': 'Bearer'})
+
+    def _batch(self, body, account):
+        '''
+        answers a multipart/mixed batch request with a
+        multipart/mixed response, each part in turn
+        '''
+        content_type = self.headers.get('Content-Type', '')
+        request = BytesParser().parsebytes(
+            b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body)
+        if not request.is_multipart():
+            self._reply(400, {}, error_body(400, 'Bad batch request', 'badRequest',
+                                            'INVALID_ARGUMENT'))
+            return
+
+        boundary = 'batch_' + uuid4().hex
+        parts = []
+        for part in request.get_payload():
+            status, headers, answer = self._batch_call(part.get_payload(decode=True), account)
+            lines = [f'HTTP/1.1 {status} {self.responses.get(status, ("",))[0]}',
+                     'Content-Type: application/json; charset=UTF-8']
+            lines.extend(f'{name}: {value}' for name, value in headers.items())
+            parts.append(
+                f'--{boundary}\r\n'
+                'Content-Type: application/http\r\n'
+                f'Content-ID: <response-{part.get("Content-ID", "").strip("<>")}>\r\n'
+                '\r\n' + '\r\n'.join(lines) + '\r\n\r\n' + json.dumps(answer) + '\r\n')
+        parts.append(f'--{boundary}--\r\n')
+        self._reply(200, {}, ''.join(parts).encode('utf-8'),
+                    content_type=f'multipart/mixed; boundary={boundary}')
+
+    def _batch_call(self, http_request:bytes, account):
+        '''
+        answers one http request from inside a batch
+        '''
+        head, _, body = http_request.replace(b'\r\n', b'\n').partition(b'\n\n')
+        request_line = head.split(b'\n', 1)[0].decode('latin-1').split()
+        if len(request_line) < 2:
+            return 400, {}, error_body(400, 'Bad request', 'badRequest', 'INVALID_ARGUMENT')
+        method, target = request_line[:2]
+        # the target may be a full url or just the path
+        path = re.sub(r'^https?://[^/]+', '', target).partition('?')[0]
+        return self.server.call(method, path, body.strip(), account)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run a fake gmail api server.')
+    add_server_args(parser)
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='port to listen on (default: %(default)s)')
+    return parser.parse_args(argv)
+
+
+def add_server_args(parser):
+    '''
+    the options for how the fake server behaves
+    (shared with load_test.py)
+    '''
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds each request takes (default: %(default)s)')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='most extra seconds a request takes, at random (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of calls that fail with a 500 (default: %(default)s)')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0,
+                        help='fraction of calls rate limited at random (default: %(default)s)')
+    parser.add_argument('--quota', type=float, default=None,
+                        help='quota units a second before calls are rate limited '
+                             '(gmail allows 250, default: no limit)')
+    parser.add_argument('--token-lifetime', type=float, default=None,
+                        help='seconds access tokens work for (default: they never expire)')
+    parser.add_argument('--daily-limit', type=int, default=None,
+                        help='messages each account can send (default: no limit)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed for the random latency and failures')
+
+
+def server_from_args(args, address):
+    return FakeGmail(address, latency=args.latency, jitter=args.jitter,
+                     error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                     quota=args.quota, token_lifetime=args.token_lifetime,
+                     daily_limit=args.daily_limit, seed=args.seed)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    server = server_from_args(args, (args.host, args.port))
+    print(f'Fake gmail listening on {server.url} (ctrl+c to stop)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.stats()))
+
+
+if __name__ == '__main__':
+    main()
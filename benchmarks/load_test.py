@@ -0,0 +1,424 @@
+#-*- coding: utf-8 -*-
+'''
+Load and soak test: sends whole campaigns through the real
+sending code (send_campaign, the sender engines, the rate
+limiter and the token refresher) to a fake gmail server.
+
+Campaigns are sent one after another until the duration is
+up, printing the send rate, request latency and memory use
+as it goes. e.g.
+
+    python benchmarks/load_test.py --contacts 10000 --duration 600 --latency 0.05 --batch-size 100
+    python benchmarks/load_test.py --engine asyncio --connections 50 --quota 250 --token-lifetime 120
+
+The fake server runs in this process unless --server is
+given the url of one started with fake_gmail.py.
+Needs the google client libraries, but nothing from
+google itself (the fake server has the discovery document
+the threads engine builds its services from)
+'''
+
+import argparse
+import json
+import math
+import platform
+import sys
+import threading
+import time
+from datetime import datetime
+from os import path
+from urllib.request import urlopen
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from aiosender import AsyncEmailer
+from fake_gmail import DISCOVERY_PATH, add_server_args, server_from_args
+from gmail import Authenicator, Message, TokenRefresher
+from metrics import REGISTRY
+from ratelimit import QuotaLimiter
+from recipients import RecipientList
+from sender import Account, SenderPool, ShardedSender, send_campaign
+
+
+class LatencyHistogram:
+    '''
+    Request latencies, counted in buckets that are each
+    GROWTH times wider than the last, so percentiles are
+    within a few percent and memory stays the same however
+    long the test runs
+    '''
+
+    SMALLEST = 1e-4
+    GROWTH = 1.05
+
+    def __init__(self):
+        self._buckets = {}
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def add(self, seconds:float):
+        index = max(0, math.ceil(math.log(max(seconds, self.SMALLEST) / self.SMALLEST,
+                                          self.GROWTH)))
+        with self._lock:
+            self._buckets[index] = self._buckets.get(index, 0) + 1
+            self.count += 1
+
+    def percentile(self, fraction:float):
+        '''
+        the latency (in seconds) that fraction of requests were quicker than
+        '''
+        with self._lock:
+            if not self.count:
+                return None
+            rank = fraction * self.count
+            seen = 0
+            for index in sorted(self._buckets):
+                seen += self._buckets[index]
+                if seen >= rank:
+                    return self.SMALLEST * self.GROWTH ** index
+
+
+class TimedHttp:
+    '''
+    Wraps an (authorized) httplib2 Http, timing each request
+    '''
+
+    def __init__(self, http, histogram:LatencyHistogram):
+        self.http = http
+        self.histogram = histogram
+        # googleapiclient looks for the credentials here to refresh batches
+        self.credentials = getattr(http.request, 'credentials', None)
+
+    def request(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.http.request(*args, **kwargs)
+        finally:
+            self.histogram.add(time.perf_counter() - start)
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+
+class TimedAsyncEmailer(AsyncEmailer):
+    '''
+    AsyncEmailer that times each request it makes
+    '''
+
+    def __init__(self, *args, histogram:LatencyHistogram, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.histogram = histogram
+
+    async def _request(self, *args):
+        start = time.perf_counter()
+        try:
+            return await super()._request(*args)
+        finally:
+            self.histogram.add(time.perf_counter() - start)
+
+
+class FakeDiscovery:
+    '''
+    The gmail discovery document, from the fake server
+    (so nothing is fetched from google)
+    '''
+
+    def __init__(self, url):
+        with urlopen(url + DISCOVERY_PATH) as response:
+            self._document = json.load(response)
+
+    def document(self, fetch=True):
+        return self._document
+
+
+def fake_credentials(url, account):
+    '''
+    oauth credentials that get their tokens from the fake server
+    (each refresh token is a different account there)
+    '''
+    from oauth2client.client import OAuth2Credentials
+    return OAuth2Credentials(
+        access_token=None, client_id='loadtest', client_secret='loadtest',
+        refresh_token=account, token_expiry=None,
+        token_uri=url + '/token', user_agent='PyMailList load test')
+
+
+class FakeAuthenicator(Authenicator):
+    '''
+    Signed in to an account on the fake server, and
+    builds services that time their requests
+    '''
+
+    def __init__(self, url, account, discovery, histogram:LatencyHistogram,
+                 limiter:QuotaLimiter):
+        from httplib2 import Http
+        super().__init__(limiter=limiter)
+        self.account = account
+        self.discovery = discovery
+        self.histogram = histogram
+        self.creds = fake_credentials(url, account)
+        self.creds.refresh(Http())
+
+    def _build(self, creds):
+        from httplib2 import Http
+        from googleapiclient.discovery import build_from_document
+        return build_from_document(self.discovery.document(),
+                                   http=TimedHttp(creds.authorize(Http()), self.histogram))
+
+
+def memory_mb():
+    '''
+    (current, peak) resident memory of this process in MB,
+    either of which is None if it can't be found out
+    (resource is unix only, psutil is used if it is installed)
+    '''
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    if resource is None:
+        try:
+            import psutil
+        except ImportError:
+            return None, None
+        info = psutil.Process().memory_info()
+        # windows keeps the peak, elsewhere psutil only has the current
+        peak = getattr(info, 'peak_wset', None)
+        return info.rss / (1024 * 1024), None if peak is None else peak / (1024 * 1024)
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, mac bytes
+    peak = peak / 1024 if sys.platform != 'darwin' else peak / (1024 * 1024)
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        current = pages * resource.getpagesize() / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        current = None
+    return current, peak
+
+
+class Progress:
+    '''
+    Counts what has been sent, from any thread
+    '''
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, envelope, sent, result):
+        with self._lock:
+            if sent:
+                self.sent += 1
+            else:
+                self.failed += 1
+                name = type(result).__name__
+                status = getattr(getattr(result, 'resp', None), 'status', None)
+                if status is not None:
+                    name = f'{name} {status}'
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+
+def make_message(args):
+    body = ('Dear {email},\n' if args.personalized else 'Hello,\n') + 'x' * args.body_size
+    message = Message()
+    message.create(to='', sender='me', subject='Load test', body=body, body_type='plain')
+    return message
+
+
+def make_contacts(count):
+    return RecipientList('\n'.join(f'person{i}@example.com' for i in range(count)))
+
+
+def sample(start, progress, histogram, last):
+    '''
+    a line of the report, since the last one
+    '''
+    now = time.monotonic()
+    current, peak = memory_mb()
+    done = progress.sent + progress.failed
+    return {
+        'elapsed': now - start,
+        'sent': progress.sent,
+        'failed': progress.failed,
+        'sends_per_second': (done - last['done']) / max(1e-9, now - last['time']),
+        'p50_ms': _ms(histogram.percentile(0.5)),
+        'p99_ms': _ms(histogram.percentile(0.99)),
+        'rss_mb': current,
+        'peak_rss_mb': peak,
+        'done': done,
+        'time': now,
+        }
+
+
+def _ms(seconds):
+    return None if seconds is None else 1000 * seconds
+
+
+def print_sample(s):
+    print('{elapsed:8.1f}s {sent:>10,} sent {failed:>7,} failed {sends_per_second:>9,.1f}/s '
+          'p50 {p50} p99 {p99} rss {rss} MB (peak {peak})'.format(
+              p50=_fmt(s['p50_ms'], 'ms'), p99=_fmt(s['p99_ms'], 'ms'),
+              rss=_fmt(s['rss_mb'], ''), peak=_fmt(s['peak_rss_mb'], ''), **s), flush=True)
+
+
+def _fmt(value, unit):
+    return '-' if value is None else f'{value:.1f}{unit}'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Send campaigns to a fake gmail server and report how it went.')
+    parser.add_argument('--server', default=None,
+                        help='url of a running fake_gmail.py (default: start one here)')
+    parser.add_argument('--engine', choices=('threads', 'asyncio'), default='threads',
+                        help='which sender to use (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='sender threads (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='messages per batched request (default: %(default)s)')
+    parser.add_argument('--connections', type=int, default=100,
+                        help='connections for the asyncio engine (default: %(default)s)')
+    parser.add_argument('--accounts', type=int, default=1,
+                        help='accounts to share the sending between (default: %(default)s)')
+    parser.add_argument('--contacts', type=int, default=1000,
+                        help='contacts in each campaign (default: %(default)s)')
+    parser.add_argument('--duration', type=float, default=0,
+                        help='keep sending campaigns for this many seconds '
+                             '(default: just send one)')
+    parser.add_argument('--body-size', type=int, default=2000,
+                        help='characters in the message body (default: %(default)s)')
+    parser.add_argument('--personalized', action='store_true',
+                        help='give the message a merge field, so each one is built in full')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='quota units a second the client limits itself to '
+                             '(default: the server quota, or unlimited)')
+    parser.add_argument('--interval', type=float, default=5,
+                        help='seconds between progress lines (default: %(default)s)')
+    parser.add_argument('--output', default=None,
+                        help='json file to save the results to')
+    parser.add_argument('--metrics', default=None,
+                        help="file to write the app's own metrics to when done "
+                             '(json if it ends in .json, otherwise prometheus text)')
+    add_server_args(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    server = None
+    url = args.server
+    if url is None:
+        server = server_from_args(args, ('127.0.0.1', 0)).start()
+        url = server.url
+    url = url.rstrip('/')
+
+    histogram = LatencyHistogram()
+    discovery = FakeDiscovery(url) if args.engine == 'threads' else None
+    margin = min(TokenRefresher.MARGIN, (args.token_lifetime or 3600) / 4)
+    # a limiter is always used, as it is what retries rate limited sends
+    rate = args.rate or args.quota or 1e9
+
+    auths = []
+    refreshers = []
+    for i in range(max(1, args.accounts)):
+        auth = FakeAuthenicator(url, f'loadtest-{i + 1}', discovery, histogram,
+                                QuotaLimiter(rate))
+        refresher = TokenRefresher(auth.creds, margin=margin)
+        refresher.start()
+        auths.append(auth)
+        refreshers.append(refresher)
+
+    def make_sender(auth):
+        if args.engine == 'asyncio':
+            return TimedAsyncEmailer(auth.access_token, base_url=url,
+                                     connections=args.connections,
+                                     concurrency=2 * args.connections,
+                                     limiter=auth.limiter, histogram=histogram)
+        return SenderPool(auth.build_service, workers=args.workers,
+                          batch_size=args.batch_size, limiter=auth.limiter)
+
+    message = make_message(args)
+    progress = Progress()
+
+    start = time.monotonic()
+    last = {'done': 0, 'time': start}
+    samples = []
+    finished = threading.Event()
+
+    def _report():
+        nonlocal last
+        while not finished.wait(args.interval):
+            last = sample(start, progress, histogram, last)
+            samples.append(last)
+            print_sample(last)
+
+    reporter = threading.Thread(target=_report, name='Reporter', daemon=True)
+    reporter.start()
+
+    campaigns = 0
+    try:
+        while True:
+            if len(auths) > 1:
+                sender = ShardedSender(Account(auth.account, make_sender(auth))
+                                       for auth in auths)
+            else:
+                sender = make_sender(auths[0])
+            send_campaign(message, make_contacts(args.contacts), None, progress,
+                          sender=sender)
+            campaigns += 1
+            if time.monotonic() - start >= args.duration:
+                break
+    except KeyboardInterrupt:
+        print('stopped')
+    finally:
+        finished.set()
+        reporter.join()
+        for refresher in refreshers:
+            refresher.stop()
+
+    total = sample(start, progress, histogram, {'done': 0, 'time': start})
+    print('\n{} campaigns, {:,} sent and {:,} failed in {:.1f}s: {:,.1f} sends/s, '
+          'p50 {} p99 {}, peak rss {} MB'.format(
+              campaigns, total['sent'], total['failed'], total['elapsed'],
+              total['sends_per_second'], _fmt(total['p50_ms'], 'ms'),
+              _fmt(total['p99_ms'], 'ms'), _fmt(total['peak_rss_mb'], '')))
+    if progress.errors:
+        print('errors: ' + ', '.join(f'{n} x {name}' for name, n in progress.errors.items()))
+
+    server_stats = None
+    if server is not None:
+        server_stats = server.stats()
+        print('server: ' + ', '.join(f'{n:,} {name}' for name, n in server_stats.items()))
+        server.stop()
+
+    if args.metrics:
+        REGISTRY.write(args.metrics)
+        print(f'metrics written to {args.metrics}')
+
+    if args.output:
+        report = {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'options': vars(args),
+            'campaigns': campaigns,
+            'total': total,
+            'errors': progress.errors,
+            'samples': samples,
+            'server': server_stats,
+            }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'saved to {args.output}')
+
+    return 1 if progress.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,235 @@
+#-*- coding: utf-8 -*-
+'''
+Sends a campaign from the command line, without the gui.
+
+Nothing here imports PyQt5, so it starts quickly and
+runs fine on a server or from cron. e.g.
+
+    python cli.py --subject "Hello {first_name}" --body news.html --contacts list.csv
+
+or, to check what would be sent without sending it,
+
+    python cli.py --subject "Hello {first_name}" --body news.html --contacts list.csv --export news.mbox
+'''
+
+import argparse
+import sys
+import time
+from os import path
+
+from attachments import Attachment
+from export import export_campaign, open_writer
+from gmail import Authenicator, Message
+from journal import SendJournal, campaign_id
+from merge import unknown_fields
+from metrics import REGISTRY
+from prerender import Prerenderer
+from aiosender import AsyncEmailer
+from ratelimit import QuotaLimiter
+from recipients import RecipientFile, RecipientList
+from scheduler import DAY, DailyPacer
+from sender import Account, SenderPool, ShardedSender, count_unsent, send_campaign
+
+
+def load_contacts(file_path):
+    '''
+    csv/tsv files are streamed with their merge fields,
+    anything else is read as one address per line
+    '''
+    if path.splitext(file_path)[1].lower() in ('.csv', '.tsv', '.tab'):
+        return RecipientFile(file_path)
+    with open(file_path, encoding='utf-8-sig') as f:
+        return RecipientList(f.read())
+
+
+def load_message(args):
+    '''
+    makes the message from the command line arguments
+    '''
+    with open(args.body, encoding='utf-8') as f:
+        body = f.read()
+    if args.html or path.splitext(args.body)[1].lower() in ('.html', '.htm'):
+        body_type = 'html'
+    else:
+        body_type = 'plain'
+    message = Message()
+    message.create(to='', sender='me', subject=args.subject,
+                   body=body, body_type=body_type,
+                   attachments=[Attachment(p) for p in args.attach or ()])
+    return message
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Send an email to a list of contacts through gmail.')
+    parser.add_argument('--subject', required=True,
+                        help='subject line (may use {merge} fields)')
+    parser.add_argument('--body', required=True,
+                        help='file holding the message body (may use {merge} fields)')
+    parser.add_argument('--html', action='store_true',
+                        help='send the body as html (the default for .html files)')
+    parser.add_argument('--attach', action='append', default=None, metavar='FILE',
+                        help='attach a file to the message (may be given more than once)')
+    parser.add_argument('--contacts', required=True,
+                        help='csv/tsv file with an email column, or one address per line')
+    parser.add_argument('--export', default=None, metavar='PATH',
+                        help='write the messages to an mbox file (if PATH ends in .mbox) '
+                             'or a directory of .eml files instead of sending them')
+    parser.add_argument('--gzip', action='store_true',
+                        help='gzip what --export writes (the default if PATH ends in .gz)')
+    parser.add_argument('--credentials', default='credentials.json',
+                        help='gmail api credentials file (default: %(default)s)')
+    parser.add_argument('--token', action='append', default=None,
+                        help='saved sign in token (default: token.json). give it more than '
+                             'once to share the sending between several accounts')
+    parser.add_argument('--no-browser', action='store_true',
+                        help='sign in by pasting a code rather than opening a browser')
+    parser.add_argument('--engine', choices=('threads', 'asyncio'), default='threads',
+                        help='send from a pool of threads, or with asyncio '
+                             'over pooled keep-alive connections (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of sender threads per account (default: %(default)s)')
+    parser.add_argument('--connections', type=int, default=100,
+                        help='most connections the asyncio engine opens per account '
+                             '(default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='messages per batched request (default: %(default)s)')
+    parser.add_argument('--bcc', type=int, nargs='?', const=Message.BCC_LIMIT, default=None,
+                        metavar='N',
+                        help='send one message bcc\'d to each group of N contacts '
+                             f'(default N: {Message.BCC_LIMIT}) instead of one each. '
+                             'only for messages without merge fields')
+    parser.add_argument('--prerender', type=int, nargs='?', const=0, default=None,
+                        metavar='N',
+                        help='render messages with merge fields in N processes '
+                             '(default N: one per cpu) ahead of the senders')
+    parser.add_argument('--daily-limit', type=int, default=None, metavar='N',
+                        help='spread the sends out to stay under N a day, counting what '
+                             'the journal sent in the last day (gmail allows 500, '
+                             'or 2,000 for google workspace)')
+    parser.add_argument('--journal', default='journal.sqlite3',
+                        help='file every send is recorded in (default: %(default)s)')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip contacts the journal says this message was already sent to')
+    parser.add_argument('--quiet', action='store_true',
+                        help='only print errors and the summary')
+    parser.add_argument('--metrics', default=None,
+                        help='file to write send, latency and auth metrics to when done '
+                             '(json if it ends in .json, otherwise prometheus text)')
+    args = parser.parse_args(argv)
+    args.token = args.token or ['token.json']
+    return args
+
+
+def make_sender(args, auth, pacer=None):
+    '''
+    the sender for one account, with the engine asked for
+    :param pacer: the account's scheduler.DailyPacer, if its sends are paced
+    '''
+    if args.engine == 'asyncio':
+        return AsyncEmailer(auth.access_token, connections=args.connections,
+                            concurrency=2 * args.connections, limiter=auth.limiter,
+                            pacer=pacer)
+    return SenderPool(auth.build_service, workers=args.workers,
+                      batch_size=args.batch_size, limiter=auth.limiter, pacer=pacer)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    message = load_message(args)
+    contacts = load_contacts(args.contacts)
+    if args.bcc and message.is_personalized():
+        print('--bcc can\'t be used with a message that has merge fields', file=sys.stderr)
+        return 2
+    unknown = unknown_fields(message.merge_fields(), contacts.fields)
+    if unknown:
+        print('The contacts have nothing to fill in {} with (write {{{{name}}}} '
+              'to send {{name}} as it is)'.format(
+                  ', '.join('{' + name + '}' for name in unknown)), file=sys.stderr)
+        return 2
+
+    if args.export:
+        try:
+            with open_writer(args.export, args.gzip) as writer:
+                report = export_campaign(message, contacts, writer, bcc_size=args.bcc)
+        finally:
+            if args.metrics:
+                REGISTRY.write(args.metrics)
+        print(report)
+        return 0
+
+    journal = SendJournal(args.journal, campaign_id(message))
+    skip = frozenset()
+    already_sent = journal.completed()
+    if already_sent:
+        if args.resume:
+            skip = already_sent
+            print(f'Resuming: skipping {len(skip)} contacts already sent to')
+        else:
+            print(f'Note: this message was already sent to {len(already_sent)} '
+                  'contacts (use --resume to skip them)')
+
+    # each account has its own quota
+    auths = []
+    for token_path in args.token:
+        auth = Authenicator(args.credentials, token_path, limiter=QuotaLimiter(),
+                            browser=not args.no_browser)
+        auth.start()
+        print('Authorized as {}'.format(auth.profile['emailAddress']))
+        auths.append(auth)
+
+    def _report(envelope, sent, e):
+        if not sent:
+            print(f'{envelope.to} . . . Error! {str(e)}', file=sys.stderr)
+        elif not args.quiet:
+            print(f'{envelope.to} . . . done')
+
+    # each account has its own daily limit too. the journal doesn't say
+    # which account sent what, so each counts every send from the last
+    # day, which can only hold them back more than needed
+    pacers = [None] * len(auths)
+    if args.daily_limit:
+        history = journal.sent_since(time.time() - DAY)
+        pacers = [DailyPacer(args.daily_limit, history=history) for _ in auths]
+        print(f'{len(history)} of the daily limit of {args.daily_limit} '
+              'sent in the last 24 hours')
+
+    accounts = None
+    pacer = None
+    if len(auths) > 1:
+        accounts = [Account(auth.profile['emailAddress'], make_sender(args, auth, account_pacer))
+                    for auth, account_pacer in zip(auths, pacers)]
+        sender = ShardedSender(accounts)
+        # send_campaign only knows of one pacer, so each account
+        # is told to expect its share of the campaign here
+        if args.daily_limit:
+            share = -(-count_unsent(contacts, skip) // len(auths))
+            for account_pacer in pacers:
+                account_pacer.expect(share)
+    else:
+        pacer = pacers[0]
+        sender = make_sender(args, auths[0], pacer)
+
+    # a message without merge fields is quicker to render here
+    prerenderer = None
+    if args.prerender is not None and message.is_personalized():
+        prerenderer = Prerenderer(message, workers=args.prerender or None,
+                                  chunk_size=args.batch_size)
+
+    try:
+        report = send_campaign(message, contacts, auths[0].build_service, _report,
+                               journal=journal, skip=skip, sender=sender,
+                               bcc_size=args.bcc, prerenderer=prerenderer, pacer=pacer)
+    finally:
+        if args.metrics:
+            REGISTRY.write(args.metrics)
+    if accounts is not None:
+        for account in accounts:
+            print(account)
+    print(report)
+    return 1 if report.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,268 @@
+# for the contacts list in the gui
+from array import array
+from operator import methodcaller
+
+from PyQt5.QtCore import QAbstractListModel, QModelIndex, Qt, pyqtSignal
+from PyQt5.QtGui import QBrush, QColor
+
+from recipients import RecipientList, is_valid
+
+
+# strips the whitespace recipients.PADDING matches off either side of a contact
+_STRIP = methodcaller('strip', ' \t\r\f\v')
+
+
+class ContactsModel(QAbstractListModel):
+    '''
+    The contacts typed, pasted or loaded into the gui,
+    one per row, for a QListView.
+
+    The view only asks for the rows it is showing, so
+    this stays quick with hundreds of thousands of contacts.
+    Whether each row is a valid, repeated or invalid address
+    is only worked out when the row is first shown, and
+    the filter only looks through the rows that matched
+    the last filter when it is typed a letter at a time
+    '''
+
+    # a row's status, once it is known
+    UNKNOWN, VALID, INVALID, DUPLICATE = range(4)
+
+    # emitted when the contacts are added to, edited or removed
+    # (not when they are filtered)
+    changed = pyqtSignal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._lines = []
+        # the status of each row, filled in as they are shown
+        self._status = bytearray()
+        # lower case address: its first row (made when first needed)
+        self._first = None
+        # the lower case lines, for filtering (made when first needed)
+        self._keys = None
+        # the filter, and the rows that match it (None for every row)
+        self._filter = ''
+        self._problems_only = False
+        self._rows = None
+
+    # the model
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._lines) if self._rows is None else len(self._rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self.source_row(index.row())
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return self._lines[row]
+        if role == Qt.ForegroundRole:
+            status = self.status(row)
+            if status == self.INVALID:
+                return QBrush(QColor('#e05252'))
+            if status == self.DUPLICATE:
+                return QBrush(QColor('#d9a441'))
+        elif role == Qt.ToolTipRole:
+            status = self.status(row)
+            if status == self.INVALID:
+                return 'Not an email address, so it will be skipped'
+            if status == self.DUPLICATE:
+                return (f'Already on row {self._first[self._keys[row]] + 1}, '
+                        'so it will be skipped')
+        return None
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if not index.isValid() or role != Qt.EditRole:
+            return False
+        line = _STRIP(str(value))
+        row = self.source_row(index.row())
+        if line == self._lines[row]:
+            return False
+        if not line:
+            self.remove_rows([index.row()])
+            return True
+        self._lines[row] = line
+        self._forget()
+        # the edit can change which other rows are repeats
+        self.dataChanged.emit(self.index(0), self.index(self.rowCount() - 1))
+        self.changed.emit()
+        return True
+
+    # the contacts
+
+    def __len__(self):
+        '''
+        the number of contacts (not just the filtered ones)
+        '''
+        return len(self._lines)
+
+    def text(self):
+        '''
+        every contact, one per line
+        '''
+        return '\n'.join(self._lines)
+
+    def recipients(self):
+        '''
+        :return: RecipientList of the contacts
+        '''
+        return RecipientList(self.text())
+
+    def set_text(self, text:str):
+        '''
+        replaces the contacts with the lines of text
+        '''
+        self.beginResetModel()
+        self._lines = self._split(text)
+        self._forget()
+        self._refilter()
+        self.endResetModel()
+        self.changed.emit()
+
+    def add_text(self, text:str):
+        '''
+        adds the lines of text to the end of the contacts
+        :return: the number of contacts added
+        '''
+        lines = self._split(text)
+        if not lines:
+            return 0
+        if self._rows is None:
+            start = len(self._lines)
+            self.beginInsertRows(QModelIndex(), start, start + len(lines) - 1)
+            self._lines.extend(lines)
+            self._forget()
+            self.endInsertRows()
+        else:
+            # only the new rows that match the filter are shown
+            self.beginResetModel()
+            self._lines.extend(lines)
+            self._forget()
+            self._refilter()
+            self.endResetModel()
+        self.changed.emit()
+        return len(lines)
+
+    def remove_rows(self, rows):
+        '''
+        removes the contacts on the (shown) rows
+        '''
+        remove = set(map(self.source_row, rows))
+        if not remove:
+            return
+        self.beginResetModel()
+        self._lines = [line for row, line in enumerate(self._lines) if row not in remove]
+        self._forget()
+        self._refilter()
+        self.endResetModel()
+        self.changed.emit()
+
+    def clear(self):
+        self.set_text('')
+
+    @staticmethod
+    def _split(text):
+        '''
+        the contacts in text (one per line, or separated by
+        commas or semicolons), without padding or blank lines
+        '''
+        text = text.replace(',', '\n').replace(';', '\n')
+        return list(filter(None, map(_STRIP, text.splitlines())))
+
+    def _forget(self):
+        '''
+        the contacts changed, so the statuses need working out again
+        '''
+        self._status = bytearray(len(self._lines))
+        self._first = None
+        self._keys = None
+
+    # the status of each row
+
+    def status(self, row:int):
+        '''
+        whether the contact on (source) row is VALID,
+        INVALID or a DUPLICATE of an earlier row
+        '''
+        status = self._status[row]
+        if status == self.UNKNOWN:
+            first = self._first_rows()
+            if not is_valid(self._lines[row]):
+                status = self.INVALID
+            elif first[self._keys[row]] != row:
+                status = self.DUPLICATE
+            else:
+                status = self.VALID
+            self._status[row] = status
+        return status
+
+    def _lower(self):
+        if self._keys is None:
+            # one lower() over all the text, rather than one per row
+            self._keys = self.text().lower().split('\n') if self._lines else []
+        return self._keys
+
+    def _first_rows(self):
+        '''
+        {lower case address: the first row it is on}
+        '''
+        if self._first is None:
+            keys = self._lower()
+            # later rows are overwritten by earlier ones
+            self._first = dict(zip(reversed(keys), range(len(keys) - 1, -1, -1)))
+        return self._first
+
+    # filtering
+
+    def source_row(self, row:int):
+        '''
+        the contact's row from its row in the (filtered) view
+        '''
+        return row if self._rows is None else self._rows[row]
+
+    def set_filter(self, text:str, problems_only:bool=False):
+        '''
+        only shows the contacts containing text (ignoring case)
+        and, if problems_only, that are invalid or repeats
+        '''
+        text = text.strip().lower()
+        if text == self._filter and problems_only == self._problems_only:
+            return
+        # a longer filter can only match rows the last one did
+        narrowing = (self._rows is not None and self._filter in text
+                     and (problems_only or not self._problems_only))
+        self.beginResetModel()
+        self._filter = text
+        self._problems_only = problems_only
+        self._refilter(self._rows if narrowing else None)
+        self.endResetModel()
+
+    def _refilter(self, rows=None):
+        '''
+        works out which rows match the filter
+        :param rows: only look at these rows (all of them if None)
+        '''
+        if not self._filter and not self._problems_only:
+            self._rows = None
+            return
+        if rows is None:
+            rows = range(len(self._lines))
+        if self._filter:
+            keys = self._lower()
+            text = self._filter
+            rows = [row for row in rows if text in keys[row]]
+        if self._problems_only:
+            status = self.status
+            rows = [row for row in rows if status(row) != self.VALID]
+        self._rows = array('L', rows)
+
+    def is_filtered(self):
+        return self._rows is not None
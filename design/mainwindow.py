@@ -67,14 +67,36 @@ class Ui_MainWindow(object):
         self.message_text_edit.setTabChangesFocus(True)
         self.message_text_edit.setObjectName("message_text_edit")
         self.horizontalLayout.addWidget(self.message_text_edit)
-        self.contacts_text_edit = QtWidgets.QTextEdit(self.centralwidget)
+        self.contacts_layout = QtWidgets.QVBoxLayout()
+        self.contacts_layout.setObjectName("contacts_layout")
+        self.contacts_line_edit = QtWidgets.QLineEdit(self.centralwidget)
         font = QtGui.QFont()
         font.setPointSize(12)
-        self.contacts_text_edit.setFont(font)
-        self.contacts_text_edit.setTabChangesFocus(True)
-        self.contacts_text_edit.setLineWrapMode(QtWidgets.QTextEdit.NoWrap)
-        self.contacts_text_edit.setObjectName("contacts_text_edit")
-        self.horizontalLayout.addWidget(self.contacts_text_edit)
+        self.contacts_line_edit.setFont(font)
+        self.contacts_line_edit.setClearButtonEnabled(True)
+        self.contacts_line_edit.setObjectName("contacts_line_edit")
+        self.contacts_layout.addWidget(self.contacts_line_edit)
+        self.contacts_list_view = QtWidgets.QListView(self.centralwidget)
+        font = QtGui.QFont()
+        font.setPointSize(12)
+        self.contacts_list_view.setFont(font)
+        self.contacts_list_view.setContextMenuPolicy(QtCore.Qt.ActionsContextMenu)
+        self.contacts_list_view.setEditTriggers(QtWidgets.QAbstractItemView.DoubleClicked|QtWidgets.QAbstractItemView.EditKeyPressed)
+        self.contacts_list_view.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
+        self.contacts_list_view.setUniformItemSizes(True)
+        self.contacts_list_view.setObjectName("contacts_list_view")
+        self.contacts_layout.addWidget(self.contacts_list_view)
+        self.contacts_status_layout = QtWidgets.QHBoxLayout()
+        self.contacts_status_layout.setObjectName("contacts_status_layout")
+        self.contacts_status_label = QtWidgets.QLabel(self.centralwidget)
+        self.contacts_status_label.setWordWrap(True)
+        self.contacts_status_label.setObjectName("contacts_status_label")
+        self.contacts_status_layout.addWidget(self.contacts_status_label)
+        self.contacts_problems_check_box = QtWidgets.QCheckBox(self.centralwidget)
+        self.contacts_problems_check_box.setObjectName("contacts_problems_check_box")
+        self.contacts_status_layout.addWidget(self.contacts_problems_check_box)
+        self.contacts_layout.addLayout(self.contacts_status_layout)
+        self.horizontalLayout.addLayout(self.contacts_layout)
         self.horizontalLayout.setStretch(0, 2)
         self.horizontalLayout.setStretch(1, 1)
         self.verticalLayout_3.addLayout(self.horizontalLayout)
@@ -123,12 +145,13 @@ class Ui_MainWindow(object):
         self.progress_bar.setTextVisible(False)
         self.progress_bar.setObjectName("progress_bar")
         self.verticalLayout_2.addWidget(self.progress_bar)
-        self.console = QtWidgets.QTextEdit(self.centralwidget)
+        self.console = QtWidgets.QPlainTextEdit(self.centralwidget)
         font = QtGui.QFont()
         font.setPointSize(12)
         self.console.setFont(font)
-        self.console.setLineWrapMode(QtWidgets.QTextEdit.NoWrap)
+        self.console.setLineWrapMode(QtWidgets.QPlainTextEdit.NoWrap)
         self.console.setReadOnly(True)
+        self.console.setMaximumBlockCount(5000)
         self.console.setObjectName("console")
         self.verticalLayout_2.addWidget(self.console)
         self.horizontalLayout_3.addLayout(self.verticalLayout_2)
@@ -142,14 +165,26 @@ class Ui_MainWindow(object):
         MainWindow.addToolBar(QtCore.Qt.TopToolBarArea, self.toolBar)
         self.action_send = QtWidgets.QAction(MainWindow)
         self.action_send.setObjectName("action_send")
+        self.action_schedule = QtWidgets.QAction(MainWindow)
+        self.action_schedule.setObjectName("action_schedule")
+        self.action_show_queue = QtWidgets.QAction(MainWindow)
+        self.action_show_queue.setObjectName("action_show_queue")
         self.action_authorize = QtWidgets.QAction(MainWindow)
         self.action_authorize.setObjectName("action_authorize")
+        self.action_import_contacts = QtWidgets.QAction(MainWindow)
+        self.action_import_contacts.setObjectName("action_import_contacts")
+        self.action_attach_files = QtWidgets.QAction(MainWindow)
+        self.action_attach_files.setObjectName("action_attach_files")
         self.action_clear_fields = QtWidgets.QAction(MainWindow)
         self.action_clear_fields.setObjectName("action_clear_fields")
         self.action_toggle_theme = QtWidgets.QAction(MainWindow)
         self.action_toggle_theme.setObjectName("action_toggle_theme")
         self.toolBar.addAction(self.action_send)
+        self.toolBar.addAction(self.action_schedule)
+        self.toolBar.addAction(self.action_show_queue)
         self.toolBar.addAction(self.action_authorize)
+        self.toolBar.addAction(self.action_import_contacts)
+        self.toolBar.addAction(self.action_attach_files)
         self.toolBar.addAction(self.action_clear_fields)
         self.toolBar.addAction(self.action_toggle_theme)
 
@@ -168,27 +203,33 @@ class Ui_MainWindow(object):
 "</style></head><body style=\" font-family:\'MS Shell Dlg 2\'; font-size:12pt; font-weight:400; font-style:normal;\">\n"
 "<p style=\"-qt-paragraph-type:empty; margin-top:0px; margin-bottom:0px; margin-left:0px; margin-right:0px; -qt-block-indent:0; text-indent:0px;\"><br /></p></body></html>"))
         self.message_text_edit.setPlaceholderText(_translate("MainWindow", "Message body (plain text or HTML)"))
-        self.contacts_text_edit.setHtml(_translate("MainWindow", "<!DOCTYPE HTML PUBLIC \"-//W3C//DTD HTML 4.0//EN\" \"http://www.w3.org/TR/REC-html40/strict.dtd\">\n"
-"<html><head><meta name=\"qrichtext\" content=\"1\" /><style type=\"text/css\">\n"
-"p, li { white-space: pre-wrap; }\n"
-"</style></head><body style=\" font-family:\'MS Shell Dlg 2\'; font-size:12pt; font-weight:400; font-style:normal;\">\n"
-"<p style=\"-qt-paragraph-type:empty; margin-top:0px; margin-bottom:0px; margin-left:0px; margin-right:0px; -qt-block-indent:0; text-indent:0px;\"><br /></p></body></html>"))
-        self.contacts_text_edit.setPlaceholderText(_translate("MainWindow", "Send the message to... (someone@example.com)"))
+        self.contacts_line_edit.setToolTip(_translate("MainWindow", "Type to filter the contacts, press Enter to add what is typed"))
+        self.contacts_line_edit.setPlaceholderText(_translate("MainWindow", "Send the message to... (someone@example.com)"))
+        self.contacts_status_label.setText(_translate("MainWindow", "No contacts"))
+        self.contacts_problems_check_box.setToolTip(_translate("MainWindow", "Only show contacts that are invalid or repeated"))
+        self.contacts_problems_check_box.setText(_translate("MainWindow", "Problems only"))
         self.clear_console_button.setText(_translate("MainWindow", "Clear Console"))
         self.toggle_console_wrap_button.setText(_translate("MainWindow", "Toggle Word Wrap"))
         self.reset_progress_bar_button.setText(_translate("MainWindow", "Reset Progress Bar"))
-        self.console.setHtml(_translate("MainWindow", "<!DOCTYPE HTML PUBLIC \"-//W3C//DTD HTML 4.0//EN\" \"http://www.w3.org/TR/REC-html40/strict.dtd\">\n"
-"<html><head><meta name=\"qrichtext\" content=\"1\" /><style type=\"text/css\">\n"
-"p, li { white-space: pre-wrap; }\n"
-"</style></head><body style=\" font-family:\'MS Shell Dlg 2\'; font-size:12pt; font-weight:400; font-style:normal;\">\n"
-"<p style=\"-qt-paragraph-type:empty; margin-top:0px; margin-bottom:0px; margin-left:0px; margin-right:0px; -qt-block-indent:0; text-indent:0px;\"><br /></p></body></html>"))
         self.toolBar.setWindowTitle(_translate("MainWindow", "toolBar"))
         self.action_send.setText(_translate("MainWindow", "Send"))
         self.action_send.setToolTip(_translate("MainWindow", "Send the message (Alt+S)"))
         self.action_send.setShortcut(_translate("MainWindow", "Alt+S"))
+        self.action_schedule.setText(_translate("MainWindow", "Schedule"))
+        self.action_schedule.setToolTip(_translate("MainWindow", "Send the message later, or with a priority (Alt+L)"))
+        self.action_schedule.setShortcut(_translate("MainWindow", "Alt+L"))
+        self.action_show_queue.setText(_translate("MainWindow", "Queue"))
+        self.action_show_queue.setToolTip(_translate("MainWindow", "Show the campaigns waiting to send (Alt+Q)"))
+        self.action_show_queue.setShortcut(_translate("MainWindow", "Alt+Q"))
         self.action_authorize.setText(_translate("MainWindow", "Authorize"))
         self.action_authorize.setToolTip(_translate("MainWindow", "Force re-authorization (Alt+A)"))
         self.action_authorize.setShortcut(_translate("MainWindow", "Alt+A"))
+        self.action_import_contacts.setText(_translate("MainWindow", "Import"))
+        self.action_import_contacts.setToolTip(_translate("MainWindow", "Import contacts from a CSV or TSV file (Alt+I)"))
+        self.action_import_contacts.setShortcut(_translate("MainWindow", "Alt+I"))
+        self.action_attach_files.setText(_translate("MainWindow", "Attach"))
+        self.action_attach_files.setToolTip(_translate("MainWindow", "Attach files to the message (Alt+F)"))
+        self.action_attach_files.setShortcut(_translate("MainWindow", "Alt+F"))
         self.action_clear_fields.setText(_translate("MainWindow", "Clear"))
         self.action_clear_fields.setToolTip(_translate("MainWindow", "Clear form input fields (Alt+C)"))
         self.action_clear_fields.setShortcut(_translate("MainWindow", "Alt+C"))
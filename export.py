@@ -0,0 +1,168 @@
+# for exporting rendered messages
+import gzip
+import io
+import re
+import time
+from collections import namedtuple
+from os import makedirs, path
+
+from sender import chunks
+
+
+# write to disk a megabyte at a time
+BUFFER_SIZE = 1 << 20
+
+# quick to compress, for most of the saving
+COMPRESS_LEVEL = 6
+
+# lines in an mbox message that would be taken for the start of
+# the next message, and lines already escaped (mboxrd style)
+_FROM_LINE = re.compile(rb'^(>*From )', re.MULTILINE)
+
+# characters that can't go in an .eml file name
+_UNSAFE = re.compile(r'[^A-Za-z0-9@._+-]')
+
+
+class MboxWriter:
+    '''
+    Writes messages one after another into an mbox file
+    (gzipped if compress), which mail clients and
+    python's mailbox module can read.
+
+    Writes are buffered, and the part of the message
+    every recipient shares is only escaped once
+    '''
+
+    def __init__(self, file_path:str, compress:bool=False):
+        self.path = file_path
+        if compress:
+            self._file = io.BufferedWriter(
+                gzip.open(file_path, 'wb', compresslevel=COMPRESS_LEVEL), BUFFER_SIZE)
+        else:
+            self._file = open(file_path, 'wb', buffering=BUFFER_SIZE)
+        self._from_line = 'From MAILER-DAEMON {}\n'.format(time.asctime()).encode('ascii')
+        self._shared = None
+        self._escaped = None
+
+    def write(self, to, head:bytes, shared:bytes):
+        '''
+        adds the message head + shared (see Message.raw_parts)
+        '''
+        if shared is not self._shared:
+            self._shared = shared
+            self._escaped = _FROM_LINE.sub(rb'>\1', shared)
+        escaped = self._escaped
+        f = self._file
+        f.write(self._from_line)
+        f.write(_FROM_LINE.sub(rb'>\1', head) if b'From ' in head else head)
+        f.write(escaped)
+        # a blank line between messages
+        f.write(b'\n' if (escaped or head).endswith(b'\n') else b'\n\n')
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class EmlWriter:
+    '''
+    Writes each message to its own .eml file in a directory
+    (gzipped if compress), named after its number and
+    who it is to
+    '''
+
+    def __init__(self, directory:str, compress:bool=False):
+        self.path = directory
+        self.compress = compress
+        self.count = 0
+        makedirs(directory, exist_ok=True)
+
+    def write(self, to, head:bytes, shared:bytes):
+        '''
+        writes the message head + shared (see Message.raw_parts)
+        '''
+        self.count += 1
+        name = '{:07d}_{}.eml'.format(self.count, _UNSAFE.sub('_', to)[:100])
+        file_path = path.join(self.path, name)
+        if self.compress:
+            f = gzip.open(file_path + '.gz', 'wb', compresslevel=COMPRESS_LEVEL)
+        else:
+            f = open(file_path, 'wb')
+        with f:
+            f.write(head)
+            f.write(shared)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_writer(output:str, compress:bool=False):
+    '''
+    an MboxWriter if output is a .mbox (or .mbox.gz) file,
+    otherwise an EmlWriter for the output directory.
+    a .gz on the end means compress
+    '''
+    if output.lower().endswith('.gz'):
+        compress = True
+    if output.lower().endswith(('.mbox', '.mbox.gz')):
+        return MboxWriter(output, compress)
+    return EmlWriter(output, compress)
+
+
+class ExportReport(namedtuple('ExportReport', ['written', 'output', 'contacts'])):
+    '''
+    counts of what was exported
+    (contacts is the recipients' CleanReport)
+    '''
+
+    def __str__(self):
+        return f'{self.written} messages written to {self.output}. {self.contacts}'
+
+
+def export_campaign(message, contacts, writer, callback=None, bcc_size:int=None):
+    '''
+    renders the message for each of the contacts, as it would
+    be sent, and writes it out instead of sending it. the
+    contacts are read as they are written, so memory
+    stays the same however long the list is
+
+    :param message: gmail.Message to render
+    :param contacts: RecipientList or RecipientFile
+    :param writer: MboxWriter or EmlWriter (see open_writer)
+    :param callback: called as callback(address) after each message is written
+    :param bcc_size: write one message bcc'd to each group of this many contacts
+                     (at most Message.BCC_LIMIT) rather than one each
+    :return: ExportReport of what was written
+    '''
+    if bcc_size:
+        message.template().check_bcc()
+
+    written = 0
+    recipients = contacts.recipients()
+    if bcc_size:
+        for group in chunks(recipients, min(bcc_size, message.BCC_LIMIT)):
+            addresses = [recipient.address for recipient in group]
+            writer.write('bcc_{}'.format(len(addresses)), *message.raw_bcc_parts(addresses))
+            written += 1
+            if callback is not None:
+                for address in addresses:
+                    callback(address)
+    else:
+        raw_parts = message.raw_parts
+        for recipient in recipients:
+            writer.write(recipient.address, *raw_parts(recipient.address, recipient.fields))
+            written += 1
+            if callback is not None:
+                callback(recipient.address)
+    return ExportReport(written, writer.path, contacts.report)
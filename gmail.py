@@ -1,24 +1,394 @@
 
 # for the authenticator
-from os import path, replace
-from googleapiclient.discovery import build
-from httplib2 import Http
-from oauth2client import file, client, tools
-from apiclient import errors
+# (the google client libraries are slow to import, so they
+# are only imported by the methods that need them)
+import json
+import threading
+import time
+from datetime import datetime
+from os import makedirs, path, replace
 
 # for the message class
 import base64
+import copy
+import email.message
+from collections import namedtuple
+from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from uuid import uuid4
+
+from merge import MergeTemplate
+from metrics import API_SECONDS, RATE_LIMITED, RENDER_SECONDS, auth_step, count_send
+from ratelimit import QuotaLimiter, QUOTA_COSTS, is_rate_error, retry_after
+
+
+class MessageTemplate:
+    '''
+    A message rendered and base64 encoded once,
+    that only needs the 'to' header spliced in
+    for each recipient.
+
+    if the subject or body has merge fields (e.g. {first_name})
+    they are compiled once instead, and each recipient gets
+    their own copy of the message filled in. only the
+    attachments (if there are any) are shared then
+
+    base64 works on groups of 3 bytes, so if the per recipient
+    header is topped up to a multiple of 3 with the first
+    few bytes of the shared part, the rest of the shared part
+    encodes the same for every recipient. it is encoded up front
+    for each of the 3 possible offsets
+    '''
+
+    # headers longer than this get folded by the email package
+    MAX_LINE_LENGTH = 78
+
+    def __init__(self, sender, subject, body, body_type, attachments=()):
+        self.sender = sender
+        self.body_type = body_type
+        self.subject = MergeTemplate(subject)
+        self.body = MergeTemplate(body, html=(body_type == 'html'))
+        self.attachments = tuple(attachments)
+        self.personalized = self.subject.has_fields or self.body.has_fields
+
+        # the attachment parts, after the text
+        # (and before them, the boundary between the parts)
+        self.boundary = None
+        tail = b''
+        if self.attachments:
+            self.boundary = ('=_' + uuid4().hex).encode('ascii')
+            tail = b''.join(b'\n--' + self.boundary + b'\n' + attachment.part()
+                            for attachment in self.attachments)
+            tail += b'\n--' + self.boundary + b'--\n'
+
+        if self.personalized:
+            self.shared = tail
+        else:
+            # (rendered, for any doubled braces)
+            self.shared = self._build(self.subject.render({}), self.body.render({})) + tail
+        self.encoded = tuple(base64.urlsafe_b64encode(self.shared[offset:])
+                             for offset in range(3))
+
+    def _build(self, subject, body):
+        '''
+        the bytes of the message, less the 'to' header
+        and the attachment parts
+        '''
+        text = MIMEText(body, self.body_type)
+        if not self.attachments:
+            text['from'] = self.sender
+            text['subject'] = subject
+            return text.as_bytes()
+
+        message = MIMEMultipart('mixed', boundary=self.boundary.decode('ascii'))
+        message['from'] = self.sender
+        message['subject'] = subject
+        del text['MIME-Version']
+        # only the headers of the (empty) multipart message
+        headers = message.as_bytes().split(b'\n\n', 1)[0]
+        return headers + b'\n\n--' + self.boundary + b'\n' + text.as_bytes()
+
+    @classmethod
+    def to_header(cls, to):
+        '''
+        the bytes of the 'to' header line, the same as the
+        email package would write them
+        '''
+        return cls.header('to', to)
+
+    @classmethod
+    def header(cls, name, value):
+        '''
+        the bytes of a header line, the same as the
+        email package would write them
+        '''
+        line = '{}: {}\n'.format(name, value)
+        if line.isascii() and len(line) <= cls.MAX_LINE_LENGTH + 1 and line.count('\n') == 1:
+            return line.encode('ascii')
+        # leave anything that needs encoding or folding to the email package
+        header = email.message.Message()
+        header[name] = value
+        return header.as_bytes()[:-1]
+
+    def render(self, to, fields:dict=None):
+        '''
+        creates the base64 encoded message object
+        addressed to :to:
+        :param fields: the recipient's merge field values.
+                       {email} is always filled in with :to:
+        '''
+        return self._splice(self.head(to, fields))
+
+    def render_bcc(self, addresses):
+        '''
+        creates the base64 encoded message object addressed
+        to nobody in particular, with everyone in :addresses:
+        on the bcc line (gmail sends it to them and drops
+        the bcc line, so they can't see each other)
+        '''
+        return self._splice(self.bcc_head(addresses))
+
+    def head(self, to, fields:dict=None):
+        '''
+        the bytes of the message addressed to :to: that
+        come before the shared part (the message is
+        head + shared, before it is base64 encoded)
+        '''
+        if self.personalized:
+            return self._personalized_head(to, fields)
+        return self.to_header(to)
+
+    def bcc_head(self, addresses):
+        '''
+        the bytes before the shared part of the
+        message bcc'd to everyone in :addresses:
+        '''
+        self.check_bcc()
+        return self.to_header(UNDISCLOSED_RECIPIENTS) + self.header('bcc', ', '.join(addresses))
+
+    def check_bcc(self):
+        '''
+        raises ValueError if the message can't be bcc'd
+        (so a send can check before it starts)
+        '''
+        if self.personalized:
+            raise ValueError('A message with merge fields is different for everyone, '
+                             'so it can\'t be bcc\'d')
+
+    def encode_head(self, head):
+        '''
+        base64 encodes the per message head, topped up
+        to a multiple of 3 bytes from the shared part
+        :return: (the encoded head, the offset of the shared
+                 part's encoding that goes after it)
+        '''
+        offset = -len(head) % 3
+        return base64.urlsafe_b64encode(head + self.shared[:offset]), offset
+
+    def _splice(self, head):
+        '''
+        puts the per message headers in front of the shared
+        part, only encoding the headers
+        '''
+        encoded, offset = self.encode_head(head)
+        return {'raw': (encoded + self.encoded[offset]).decode()}
+
+    def heads_only(self):
+        '''
+        a copy that can only make and encode the heads, without
+        the shared part (besides the bytes encode_head tops up
+        with), e.g. to send to another process
+        '''
+        template = copy.copy(self)
+        template.shared = self.shared[:2]
+        template.encoded = None
+        return template
+
+    def _personalized_head(self, to, fields):
+        '''
+        fills in the merge fields and builds the message
+        for one recipient, to go in front of the shared attachments
+        '''
+        if fields is None:
+            fields = {'email': to}
+        elif 'email' not in fields:
+            fields = dict(fields, email=to)
+        return self.to_header(to) + self._build(self.subject.render(fields),
+                                                self.body.render(fields))
+
+
+# render times, split by whether the message was spliced
+# from the shared template or merged and built in full
+_RENDER_SHARED = RENDER_SECONDS.labels(kind='shared')
+_RENDER_MERGED = RENDER_SECONDS.labels(kind='merged')
+
+# a single, finished message bound for a single recipient
+# (or, if bcc is a tuple of addresses, for all of them).
+# immutable so it can be handed between threads safely
+Envelope = namedtuple('Envelope', ['to', 'sender', 'message', 'bcc'], defaults=(None,))
+
+# who a message with only bcc recipients is to
+UNDISCLOSED_RECIPIENTS = 'undisclosed-recipients:;'
+
+
+class DiscoveryCache:
+    '''
+    Keeps the api's discovery document on disk,
+    so building a service doesn't fetch and parse
+    it from google every time.
+
+    The cached copy is thrown out when it gets old or
+    the google client library is upgraded. Once loaded
+    it is kept in memory for every service built after
+    '''
+
+    URL = 'https://www.googleapis.com/discovery/v1/apis/{api}/{version}/rest'
+
+    # refetch the document after a week
+    MAX_AGE = 7 * 24 * 60 * 60
+
+    # documents already loaded in this process, by path
+    _documents = {}
+    _lock = threading.Lock()
+
+    def __init__(self, cache_dir='discovery_cache', api='gmail', version='v1'):
+        self.cache_dir = cache_dir
+        self.api = api
+        self.version = version
+
+    @property
+    def path(self):
+        return path.join(self.cache_dir, f'{self.api}-{self.version}.json')
+
+    def document(self, fetch:bool=True):
+        '''
+        the discovery document, from memory, the disk or
+        google (in that order of preference)
+        :param fetch: False to return None rather than
+                      go to google for it
+        '''
+        with self._lock:
+            document = self._documents.get(self.path)
+            if document is None:
+                document = self._load()
+                if document is None:
+                    if not fetch:
+                        return None
+                    document = self._fetch()
+                    self._save(document)
+                self._documents[self.path] = document
+            return document
+
+    def _client_version(self):
+        import googleapiclient
+        return googleapiclient.__version__
+
+    def _load(self):
+        '''
+        the cached document, or None if
+        there isn't a usable one
+        '''
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached.get('client_version') != self._client_version():
+            return None
+        if time.time() - cached.get('fetched', 0) > self.MAX_AGE:
+            return None
+        return cached.get('document')
+
+    def _fetch(self):
+        '''
+        gets the document from google
+        '''
+        from httplib2 import Http
+        from googleapiclient.errors import HttpError
+        url = self.URL.format(api=self.api, version=self.version)
+        resp, content = Http().request(url)
+        if resp.status >= 400:
+            raise HttpError(resp, content, uri=url)
+        return json.loads(content.decode('utf-8'))
+
+    def _save(self, document):
+        '''
+        writes the document to disk (to a temporary file
+        first, so a half written cache is never read)
+        '''
+        cached = {
+            'client_version': self._client_version(),
+            'fetched': time.time(),
+            'document': document,
+            }
+        try:
+            makedirs(self.cache_dir, exist_ok=True)
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(cached, f)
+            replace(temp_path, self.path)
+        except OSError as e:
+            print(f'Could not cache the discovery document: {e}')
+
+
+class TokenRefresher:
+    '''
+    Refreshes the access token in a background thread
+    a little before it expires.
+
+    Every sender's http connection is authorized with the same
+    credentials object, so they all pick up the new token on
+    their next request, and none of them ever has to stop and
+    refresh it after a 401. oauth2client refreshes under the
+    token storage's lock, so this can't race a sender's refresh
+    '''
+
+    # refresh this many seconds before the token expires
+    MARGIN = 5 * 60
+
+    # how long to wait before trying again if a refresh fails
+    RETRY_DELAY = 30
+
+    # how often to refresh if the token doesn't say when it expires
+    DEFAULT_LIFETIME = 55 * 60
+
+    def __init__(self, creds, margin:float=MARGIN):
+        self.creds = creds
+        self.margin = margin
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='TokenRefresher', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def seconds_left(self):
+        '''
+        seconds until the access token expires
+        '''
+        expiry = getattr(self.creds, 'token_expiry', None)
+        if expiry is None:
+            return self.DEFAULT_LIFETIME
+        # oauth2client keeps the expiry as a naive utc datetime
+        return (expiry - datetime.utcnow()).total_seconds()
+
+    def _run(self):
+        while not self._stop.wait(max(0, self.seconds_left() - self.margin)):
+            self.refresh()
+
+    def refresh(self):
+        '''
+        gets a new access token now
+        :return: True if it worked
+        '''
+        from httplib2 import Http
+        try:
+            with auth_step('refresh'):
+                self.creds.refresh(Http())
+        except Exception as e:
+            print(f'Could not refresh the access token: {e}')
+            self._stop.wait(self.RETRY_DELAY)
+            return False
+        return True
+
 
 class Authenicator:
     '''
     Authenticates and manages a google web service
     '''
 
-    def __init__(self, credential_path=None, token_path=None):
+    def __init__(self, credential_path=None, token_path=None, limiter:QuotaLimiter=None,
+                 browser:bool=True):
         self._SCOPES = ('https://www.googleapis.com/auth/gmail.send ' + 'https://www.googleapis.com/auth/gmail.readonly')
         self.credential_path = credential_path
         self.token_path = token_path
+        self.limiter = limiter
+        self.browser = browser # False to sign in by pasting a code instead
+        self.discovery = DiscoveryCache()
+        self.refresher:TokenRefresher = None
+        self.creds = None
         self.service = None
         self.profile = None
         
@@ -29,17 +399,73 @@ class Authenicator:
         creates service to gmail account based on SCOPES
         also gets the profile data of the user
         '''
-        creds = self._credentials()
-        self.service = self._build(creds)
+        with auth_step('credentials'):
+            self.creds = self._credentials()
+        self._start_refresher()
+        with auth_step('build'):
+            self.service = self._build(self.creds)
         self.profile = self._get_profile()
+        self._save_profile()
 
 
     def start_from_local(self):
         '''
         gets the users credentials to start
         the service from local storage if possible
+        (the token, discovery document and profile saved
+        last time) without going over the network.
+        the profile can be checked later with revalidate_profile
+        :return: True if it worked, False if start is needed
+        '''
+        from oauth2client import file
+        try:
+            creds = file.Storage(self.token_path).get()
+        except (OSError, ValueError, KeyError):
+            return False
+        # an expired access token is fine, it is refreshed on
+        # first use. an invalid one needs the user to sign in
+        if not creds or creds.invalid:
+            return False
+
+        profile = self._load_profile()
+        if profile is None or self.discovery.document(fetch=False) is None:
+            return False
+
+        self.creds = creds
+        self._start_refresher()
+        with auth_step('build'):
+            self.service = self._build(creds)
+        self.profile = profile
+        return True
+
+
+    def _start_refresher(self):
+        '''
+        keeps the (new) credentials fresh
+        in the background
+        '''
+        self.stop()
+        self.refresher = TokenRefresher(self.creds)
+        self.refresher.start()
+
+
+    def stop(self):
+        '''
+        stops refreshing the credentials
+        '''
+        if self.refresher is not None:
+            self.refresher.stop()
+            self.refresher = None
+
+
+    def revalidate_profile(self):
+        '''
+        gets the profile from gmail again, after a start_from_local
+        (this is also the first real use of the saved token)
         '''
-        pass
+        self.profile = self._get_profile()
+        self._save_profile()
+        return self.profile
 
 
     def restart(self):
@@ -56,26 +482,76 @@ class Authenicator:
         get the credentials from storage if possible
         if not, get it from the login page
         '''
+        from oauth2client import file, client, tools
         store = file.Storage(self.token_path) # 'token.json'
         creds = store.get()
         if not creds or creds.invalid:
             flow = client.flow_from_clientsecrets(self.credential_path, self._SCOPES) # 'credentials.json'
-            creds = tools.run_flow(flow, store)
+            # give the flow its own flags, otherwise it parses sys.argv
+            flags = tools.argparser.parse_args([] if self.browser else ['--noauth_local_webserver'])
+            creds = tools.run_flow(flow, store, flags)
         return creds
 
     
     def _build(self, creds):
         '''
         builds the gmail service
+        from the cached discovery document
+        '''
+        from httplib2 import Http
+        from googleapiclient.discovery import build_from_document
+        return build_from_document(self.discovery.document(), http=creds.authorize(Http()))
+
+    def build_service(self):
+        '''
+        builds another gmail service from the existing credentials.
+        each one gets its own http connection, so use one per thread
+        (httplib2 is not thread safe)
         '''
-        return build('gmail', 'v1', http=creds.authorize(Http()))
+        return self._build(self.creds)
+
+    def access_token(self):
+        '''
+        the current access token, refreshed first if it has
+        expired (for senders that don't go through httplib2)
+        '''
+        if self.creds.access_token_expired:
+            from httplib2 import Http
+            with auth_step('refresh'):
+                self.creds.refresh(Http())
+        return self.creds.access_token
 
     def _get_profile(self):
         '''
         gets the profile data from the user
         return is a dictionary of the profile data
         '''
-        return self.service.users().getProfile(userId='me').execute()
+        if self.limiter is not None:
+            self.limiter.acquire(QUOTA_COSTS['getProfile'])
+        with auth_step('profile'):
+            return self.service.users().getProfile(userId='me').execute()
+
+    @property
+    def profile_path(self):
+        '''
+        where the profile is saved, next to the token
+        '''
+        (root, ext) = path.splitext(self.token_path)
+        return root + '-profile' + ext
+
+    def _load_profile(self):
+        try:
+            with open(self.profile_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_profile(self):
+        try:
+            with open(self.profile_path, 'w', encoding='utf-8') as f:
+                json.dump(self.profile, f)
+        except OSError as e:
+            print(f'Could not save the profile: {e}')
 
     def remove(self):
         '''
@@ -99,6 +575,10 @@ class Message:
     (e.g. with a different send-to address)
     '''
 
+    # most addresses to bcc one message to. gmail takes up to 500,
+    # but a smaller group means fewer people miss out if it fails
+    BCC_LIMIT = 100
+
 
     def __init__(self):
         self.subject:str = None
@@ -106,9 +586,12 @@ class Message:
         self.to:str = None # 'me'
         self.sender:str = None
         self.body_type:str = None # 'plain' or 'html'
+        self.attachments:list = [] # of attachments.Attachment
+        self._template:MessageTemplate = None
+        self._template_key = None
 
 
-    def create(self, to, sender, subject, body, body_type):
+    def create(self, to, sender, subject, body, body_type, attachments=()):
         '''
         creates a base64 encoded message object
         makes it based on the inputs
@@ -118,6 +601,7 @@ class Message:
         self.to = to # 'me'
         self.sender = sender
         self.body_type = body_type # 'plain' or 'html'
+        self.attachments = list(attachments)
         return self.recreate()
 
     def recreate(self):
@@ -125,15 +609,104 @@ class Message:
         creates a message base64 encoded message object
         based on already existing object properties
         '''
-        message = MIMEText(self.body, self.body_type)
-        message['to'] = self.to
-        message['from'] = self.sender
-        message['subject'] = self.subject
-        raw = base64.urlsafe_b64encode(message.as_bytes())
-        raw = raw.decode()
-        self.message = {'raw': raw}
+        self.message = self._render(self.to)
         return self.message
 
+    def envelope(self, to, fields:dict=None):
+        '''
+        creates the message for a single recipient
+        without changing this object
+        :param fields: the recipient's merge field values
+                       (e.g. {'first_name': 'Bob'})
+        :return: Envelope of the recipient, sender and message
+        '''
+        return Envelope(to, self.sender, self._render(to, fields))
+
+    def bcc_envelope(self, addresses):
+        '''
+        creates one message bcc'd to all of the addresses
+        without changing this object. the message
+        can't have merge fields
+        :param addresses: at most BCC_LIMIT of them
+        :return: Envelope with the addresses as its bcc
+        '''
+        addresses = tuple(addresses)
+        if len(addresses) > self.BCC_LIMIT:
+            raise ValueError(f'Cannot bcc more than {self.BCC_LIMIT} addresses at once')
+        return Envelope(UNDISCLOSED_RECIPIENTS, self.sender,
+                        self.template().render_bcc(addresses), addresses)
+
+    def raw_parts(self, to, fields:dict=None):
+        '''
+        creates the message for a single recipient as it
+        would be sent, but not base64 encoded (e.g. to save
+        as an .eml file) without changing this object
+        :return: (the bytes for the recipient, the bytes every
+                 recipient shares), which together are the message
+        '''
+        template = self.template()
+        start = time.perf_counter()
+        head = template.head(to, fields)
+        (_RENDER_MERGED if template.personalized else _RENDER_SHARED).observe(
+            time.perf_counter() - start)
+        return head, template.shared
+
+    def raw_bcc_parts(self, addresses):
+        '''
+        the same as raw_parts, for the one message
+        bcc'd to all of the addresses
+        '''
+        template = self.template()
+        return template.bcc_head(addresses), template.shared
+
+    def raw(self, to, fields:dict=None):
+        '''
+        the bytes of the message for a single recipient
+        '''
+        return b''.join(self.raw_parts(to, fields))
+
+    def merge_fields(self):
+        '''
+        the names of the merge fields in the subject and body
+        '''
+        template = self.template()
+        return sorted(set(template.subject.names + template.body.names))
+
+    def is_personalized(self):
+        '''
+        whether the message has merge fields, and
+        so is different for every recipient
+        '''
+        return self.template().personalized
+
+    def _render(self, to, fields=None):
+        '''
+        creates the base64 encoded message object
+        addressed to :to:
+        '''
+        template = self.template()
+        start = time.perf_counter()
+        message = template.render(to, fields)
+        (_RENDER_MERGED if template.personalized else _RENDER_SHARED).observe(
+            time.perf_counter() - start)
+        return message
+
+    def template(self):
+        '''
+        the encoded template of this message, which is
+        only rebuilt when the shared properties change
+        '''
+        key = (self.sender, self.subject, self.body, self.body_type,
+               tuple(self.attachments))
+        if self._template is None or self._template_key != key:
+            self._template = MessageTemplate(*key)
+            self._template_key = key
+        return self._template
+
+
+_API_SEND = API_SECONDS.labels(method='messages.send')
+_API_BATCH = API_SECONDS.labels(method='batch')
+
 
 class Emailer:
     '''
@@ -142,25 +715,145 @@ class Emailer:
     Also holds a single message
     '''
 
-    def __init__(self, service):
+    # gmail won't take more than this many calls in one batch request
+    BATCH_LIMIT = 100
+
+    # how many times to retry a message gmail rate limited
+    MAX_RETRIES = 5
+
+    def __init__(self, service, limiter:QuotaLimiter=None):
         self.service = service
+        self.limiter = limiter
         self.message = Message()
 
-    def send(self):
+    def _acquire(self, count=1):
         '''
-        safely sends the message that already
-        exists within the object
+        waits for the quota to send count messages
+        '''
+        if self.limiter is not None:
+            self.limiter.acquire(count * QUOTA_COSTS['messages.send'])
+
+    def _succeeded(self):
+        if self.limiter is not None:
+            self.limiter.success()
+
+    def _rate_limited(self, e):
+        '''
+        returns true if the error means we should slow down and
+        try again (and does the slowing down), false otherwise
+        '''
+        if self.limiter is None or not is_rate_error(e):
+            return False
+        self.limiter.backoff(retry_after(e))
+        return True
+
+    def send(self, envelope:Envelope=None):
+        '''
+        safely sends the envelope, or if there isn't one
+        the message that already exists within the object
+        if gmail rate limits it, it is retried after backing off
         if there is an error, it will print it and return False, error
         if the message sends successfully, it will return True, sent_message
         '''
+        from googleapiclient.errors import HttpError
+        if envelope is None:
+            envelope = Envelope(self.message.to, self.message.sender, self.message.message)
+        for attempt in range(self.MAX_RETRIES + 1):
+            self._acquire()
+            try:
+                with _API_SEND.time():
+                    sent_msg = (self.service.users().messages().send(
+                        userId=envelope.sender, 
+                        body=envelope.message
+                        ).execute())
+            except HttpError as e:
+                if attempt < self.MAX_RETRIES and self._rate_limited(e):
+                    RATE_LIMITED.inc()
+                    continue
+                print('An error occurred: {}'.format(e))
+                count_send(e)
+                return False, e
+            else:
+                self._succeeded()
+                count_send()
+                return True, sent_msg
+
+    def send_batch(self, envelopes, callback):
+        '''
+        sends several envelopes with a single batched http request
+        rather than making a round-trip for each one
+        messages gmail rate limits are retried in a
+        follow up batch after backing off
+
+        :param envelopes: list of Envelope. there can be
+                          at most BATCH_LIMIT of them
+        :param callback: called as callback(envelope, sent, sent_msg_or_error)
+                         once for each envelope, in the same fashion as
+                         the return value of send
+        '''
+        if len(envelopes) > self.BATCH_LIMIT:
+            raise ValueError(f'Cannot batch more than {self.BATCH_LIMIT} messages at once')
+
+        for attempt in range(self.MAX_RETRIES + 1):
+            last_attempt = attempt == self.MAX_RETRIES
+            envelopes, rate_error = self._send_batch_once(envelopes, callback, last_attempt)
+            if not envelopes:
+                return
+            # only back off once per batch, however many messages it hit
+            self._rate_limited(rate_error)
+
+    def _send_batch_once(self, envelopes, callback, last_attempt):
+        '''
+        sends a single batch request
+        :return: (envelopes that were rate limited and should be
+                 retried, the rate limit error)
+        '''
+        from googleapiclient.errors import HttpError
+        pending = {}
+        retry = []
+        rate_errors = []
+
+        def _batch_callback(request_id, response, exception):
+            envelope = pending.pop(request_id)
+            if exception is None:
+                self._succeeded()
+                count_send()
+                callback(envelope, True, response)
+            elif (not last_attempt and self.limiter is not None
+                  and is_rate_error(exception)):
+                RATE_LIMITED.inc()
+                retry.append(envelope)
+                rate_errors.append(exception)
+            else:
+                print('An error occurred: {}'.format(exception))
+                count_send(exception)
+                callback(envelope, False, exception)
+
+        self._acquire(len(envelopes))
+        batch = self.service.new_batch_http_request(callback=_batch_callback)
+        for i, envelope in enumerate(envelopes):
+            # batch request ids must be unique strings, addresses might not be
+            request_id = str(i)
+            pending[request_id] = envelope
+            batch.add(
+                self.service.users().messages().send(
+                    userId=envelope.sender,
+                    body=envelope.message),
+                request_id=request_id)
+
         try:
-            sent_msg = (self.service.users().messages().send(
-                userId=self.message.sender, 
-                body=self.message.message
-                ).execute())
-            success = True, sent_msg
-        except errors.HttpError as e:
+            with _API_BATCH.time():
+                batch.execute()
+        except HttpError as e:
+            # the whole batch failed, so every message not yet
+            # reported on failed along with it
+            if (not last_attempt and self.limiter is not None
+                    and is_rate_error(e)):
+                RATE_LIMITED.inc(len(pending))
+                return retry + list(pending.values()), e
             print('An error occurred: {}'.format(e))
-            success = False, e
-        finally:
-            return success
\ No newline at end of file
+            for envelope in list(pending.values()):
+                count_send(e)
+                callback(envelope, False, e)
+
+        return retry, rate_errors[0] if rate_errors else None
@@ -0,0 +1,129 @@
+# for the send journal
+import hashlib
+import sqlite3
+import threading
+import time
+
+
+def campaign_id(message):
+    '''
+    names a campaign after the message being sent, so sending
+    the same message again picks up the same campaign
+    :param message: gmail.Message
+    '''
+    parts = [message.sender, message.subject, message.body, message.body_type]
+    # (only when there are any, so ids from before attachments still match)
+    parts.extend(attachment.path for attachment in message.attachments)
+    key = '\0'.join(str(part) for part in parts)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+class SendJournal:
+    '''
+    Append-only record of every message sent (or not),
+    kept in a sqlite database on disk.
+
+    Each record is committed as soon as it is made, so if the
+    app dies partway through a campaign, the journal knows
+    everyone who was already sent to and they can be skipped
+    (a record lost in a crash would mean sending them the
+    message twice). With WAL and synchronous=NORMAL a commit
+    doesn't wait on the disk, so this costs little per send.
+    Records can be buffered instead with flush_every, where
+    a duplicate now and then doesn't matter
+    '''
+
+    def __init__(self, db_path:str='journal.sqlite3', campaign:str=None,
+                 flush_every:int=1, flush_seconds:float=1.0):
+        '''
+        :param db_path: the sqlite database file
+        :param campaign: id of the campaign being sent
+        :param flush_every: most records to hold before writing them
+                            (1 writes each one straight away)
+        :param flush_seconds: longest to hold a record before writing it
+        '''
+        self.db_path = db_path
+        self.campaign = campaign
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self._pending = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+        # written to from every sender thread, under the lock
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS sends ('
+            'campaign TEXT NOT NULL, '
+            'address TEXT NOT NULL, '
+            'sent INTEGER NOT NULL, '
+            'detail TEXT, '
+            'at REAL NOT NULL)')
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS sends_campaign_address '
+            'ON sends (campaign, address)')
+        # for the scheduler pacing sends to the daily limit
+        self._db.execute('CREATE INDEX IF NOT EXISTS sends_at ON sends (at)')
+        self._db.commit()
+
+    def completed(self, since:float=0):
+        '''
+        the set of (lower case) addresses this campaign
+        has already sent to, for quick lookups
+        :param since: only count sends after this time.time()
+        '''
+        with self._lock:
+            # (with anything still buffered)
+            self._flush()
+            rows = self._db.execute(
+                'SELECT address FROM sends WHERE campaign = ? AND sent = 1 AND at >= ?',
+                (self.campaign, since))
+            return {address for (address,) in rows}
+
+    def sent_since(self, since:float):
+        '''
+        the times of every message sent after since,
+        in any campaign, oldest first
+        '''
+        with self._lock:
+            self._flush()
+            rows = self._db.execute(
+                'SELECT at FROM sends WHERE sent = 1 AND at >= ? ORDER BY at', (since,))
+            return [at for (at,) in rows]
+
+    def record(self, address:str, sent:bool, detail:str=None):
+        '''
+        notes that a message was sent to (or failed to send to) address
+        '''
+        with self._lock:
+            self._pending.append((self.campaign, address.lower(), int(sent),
+                                  detail, time.time()))
+            if (len(self._pending) >= self.flush_every
+                    or time.monotonic() - self._last_flush >= self.flush_seconds):
+                self._flush()
+
+    def _flush(self):
+        '''
+        writes out the buffered records (call while holding the lock)
+        '''
+        if self._pending:
+            self._db.executemany(
+                'INSERT INTO sends (campaign, address, sent, detail, at) '
+                'VALUES (?, ?, ?, ?, ?)', self._pending)
+            self._db.commit()
+            self._pending = []
+        self._last_flush = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        '''
+        writes out anything still buffered and closes the database
+        '''
+        with self._lock:
+            self._flush()
+            self._db.close()
@@ -2,20 +2,34 @@
 
 import sys
 import time
+import threading
 import traceback
+import multiprocessing
 from pathlib import Path
-from collections import OrderedDict
+from collections import OrderedDict, deque
 
 #import subprocess
 #subprocess.call(['python', '-m', 'PyQt5.uic.pyuic', '-x', 'design\\mainwindow.ui', '-o', 'design\\mainwindow.py'])
 # python -m PyQt5.uic.pyuic -x mainwindow.ui -o mainwindow.py
 
 from design.mainwindow import Ui_MainWindow
-from gmail import Authenicator, Emailer
-
-from PyQt5.QtCore import pyqtSignal, QObject, QRunnable, pyqtSlot, QThreadPool, pyqtSlot, QFile, QTextStream
-from PyQt5.QtWidgets import QApplication, QMainWindow, QDialog, QMessageBox, QTextEdit
-from PyQt5.QtGui import QIcon, QPixmap
+from gmail import Authenicator, Emailer, Message
+from sender import send_campaign
+from aiosender import AsyncEmailer
+from prerender import Prerenderer
+from recipients import RecipientFile
+from contactsmodel import ContactsModel
+from ratelimit import QuotaLimiter, is_daily_limit_error
+from journal import SendJournal, campaign_id
+from merge import unknown_fields
+from scheduler import DAILY_LIMIT, DAY, CampaignQueue, DailyPacer, load_campaign, skip_for
+from attachments import Attachment
+from metrics import REGISTRY
+
+from PyQt5.QtCore import pyqtSignal, QObject, QRunnable, pyqtSlot, QThreadPool, pyqtSlot, QFile, QTextStream, QTimer, Qt, QDateTime
+from PyQt5.QtWidgets import (QApplication, QMainWindow, QDialog, QMessageBox, QFileDialog, QAction,
+                             QDateTimeEdit, QDialogButtonBox, QFormLayout, QSpinBox)
+from PyQt5.QtGui import QIcon, QPixmap, QKeySequence
 
 class WorkerSignals(QObject):
     '''
@@ -84,6 +98,43 @@ class Worker(QRunnable):
             self.signals.finished.emit()
 
 
+class ProgressBuffer:
+    '''
+    Collects progress from the sender threads
+    so the gui can pick it all up a few times a second,
+    instead of handling a signal for every message
+
+    only the most recent max_lines log lines are
+    kept, since the console wouldn't show any more
+    '''
+
+    def __init__(self, max_lines:int=None):
+        self._lock = threading.Lock()
+        self._count = 0
+        self._lines = deque(maxlen=max_lines)
+
+    def add(self, line:str=None):
+        '''
+        notes one more thing done (and a line to log about it)
+        can be called from any thread
+        '''
+        with self._lock:
+            self._count += 1
+            if line is not None:
+                self._lines.append(line)
+
+    def drain(self):
+        '''
+        takes everything added since the last drain
+        :return: (number of things done, list of lines to log)
+        '''
+        with self._lock:
+            count, lines = self._count, list(self._lines)
+            self._count = 0
+            self._lines.clear()
+        return count, lines
+
+
 class ApplicationWindow(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -92,24 +143,115 @@ class ApplicationWindow(QMainWindow):
         self.ui.setupUi(self)
         self._setupUi_extra()
 
-        self.auth = Authenicator('credentials.json', 'token.json')
+        # every gmail api call shares the one account's quota
+        self.limiter = QuotaLimiter()
+
+        self.auth = Authenicator('credentials.json', 'token.json', limiter=self.limiter)
         self.email = Emailer(service=None)
 
+        # how many messages go into each batched send request
+        # and how many threads send them at once
+        self.batch_size = Emailer.BATCH_LIMIT
+        self.send_workers = 4
+
+        # send messages without merge fields bcc'd to
+        # groups of this many contacts (None sends one each)
+        self.bcc_size = None
+
+        # 'threads' sends with a pool of threads (above),
+        # 'asyncio' with pooled connections on a single thread
+        self.send_engine = 'threads'
+        self.send_connections = 100
+
+        # render messages with merge fields in this many processes
+        # ahead of the senders (0 for one per cpu, None renders
+        # them on the sender threads)
+        self.prerender_workers = None
+
+        # where to write the metrics after each send
+        # (json if it ends in .json, otherwise prometheus text)
+        self.metrics_path = None
+
+        # every send is recorded here so an interrupted
+        # send can be picked up where it left off
+        self.journal_path = 'journal.sqlite3'
+
+        # campaigns wait their turn here (in the journal's database,
+        # so they carry on after a restart)
+        self.queue = CampaignQueue(self.journal_path)
+        self._queued = None
+        self._queue_timer = QTimer(self)
+        self._queue_timer.setInterval(30 * 1000)
+        self._queue_timer.timeout.connect(self._run_queue)
+        self._queue_timer.start()
+
+        # the account's daily sending limit (2,000 for a google
+        # workspace account, None to not pace the sends). a campaign
+        # that fits in what is left of today's limit goes straight
+        # out, a bigger one is spread out to stay under it, counting
+        # what the journal sent in the last day
+        self.daily_limit = DAILY_LIMIT
+        self.pacer = None
+        if self.daily_limit:
+            journal = SendJournal(self.journal_path)
+            self.pacer = DailyPacer(self.daily_limit,
+                                    history=journal.sent_since(time.time() - DAY))
+            journal.close()
+        self._closing = False
+        self._daily_limited = False
+        self._send_error = None
+        self._send_report = None
+        self._last_failure = None
+        # the saved sign in is being checked with gmail,
+        # so the queue waits to see if it still works
+        self._revalidating = False
+
+        # contacts are parsed when first needed
+        # (or streamed from an imported file)
+        self._contacts = None
+        self._contacts_file = None
+
+        # the contacts list only draws the rows on screen
+        self.contacts_model = ContactsModel(self)
+        self.ui.contacts_list_view.setModel(self.contacts_model)
+        self._setup_contacts_actions()
+
+        # the count of contacts is updated once typing stops
+        self._contacts_status_timer = QTimer(self)
+        self._contacts_status_timer.setSingleShot(True)
+        self._contacts_status_timer.setInterval(250)
+        self._contacts_status_timer.timeout.connect(self._update_contacts_status)
+
+        # files attached to the message
+        self.attachments = []
+
         # note that we are not yet authorized, nor are we sending anything
         self._sender_thread_is_running = False
         self._auth_thread_is_running = False
         self._authorized = False
 
+        # sender progress is shown a few times a second
+        # rather than every time a message is sent
+        self._progress = ProgressBuffer(self.ui.console.maximumBlockCount())
+        self._progress_timer = QTimer(self)
+        self._progress_timer.setInterval(200)
+        self._progress_timer.timeout.connect(self._show_progress)
+
         # init thread pool
         self.threadpool = QThreadPool()
         self.console_log('{} threads available or multi-threading'.format(self.threadpool.maxThreadCount()))
 
-        # try to authorize
-        self.start_authorize_thread()
+        # try to authorize (straight away from the
+        # saved sign in, if there is one)
+        self.authorize_from_local()
 
         # connect actions
         self.ui.action_send.triggered.connect(self.send)
         self.ui.action_authorize.triggered.connect(self.force_authorize)
+        self.ui.action_import_contacts.triggered.connect(self.import_contacts)
+        self.ui.action_attach_files.triggered.connect(self.attach_files)
+        self.ui.action_schedule.triggered.connect(self.schedule)
+        self.ui.action_show_queue.triggered.connect(self.show_queue)
         self.ui.action_clear_fields.triggered.connect(self.clear)
         self.ui.action_toggle_theme.triggered.connect(self.cycle_stylesheet)
 
@@ -118,6 +260,12 @@ class ApplicationWindow(QMainWindow):
         self.ui.toggle_console_wrap_button.clicked.connect(lambda: self.toggle_word_wrap(self.ui.console))
         self.ui.reset_progress_bar_button.clicked.connect(self.reset_progress_bar)
 
+        # connect edits
+        self.contacts_model.changed.connect(self._contacts_changed)
+        self.ui.contacts_line_edit.textChanged.connect(self._filter_contacts)
+        self.ui.contacts_line_edit.returnPressed.connect(self.add_typed_contacts)
+        self.ui.contacts_problems_check_box.toggled.connect(self._filter_contacts)
+
 
     def _setupUi_extra(self):
         '''
@@ -141,10 +289,12 @@ class ApplicationWindow(QMainWindow):
         '''
         toggles the word wrap in a text edit object
         '''
-        if text_edit.lineWrapMode() == QTextEdit.NoWrap:
-            text_edit.setLineWrapMode(QTextEdit.WidgetWidth)
+        # QTextEdit and QPlainTextEdit each have their own enum
+        modes = type(text_edit)
+        if text_edit.lineWrapMode() == modes.NoWrap:
+            text_edit.setLineWrapMode(modes.WidgetWidth)
         else:
-            text_edit.setLineWrapMode(QTextEdit.NoWrap)
+            text_edit.setLineWrapMode(modes.NoWrap)
 
 
     def reset_progress_bar(self):
@@ -243,9 +393,61 @@ class ApplicationWindow(QMainWindow):
         if self._authorized:
             self.console_log('Authorized as {}'.format(self.auth.profile['emailAddress']))
             self.setWindowTitle('PyMailList - ' + self.auth.profile['emailAddress'])
+            # start anything waiting on the queue
+            QTimer.singleShot(0, self._run_queue)
         else:
             self.console_log('Authorization failed')
 
+    def authorize_from_local(self):
+        '''
+        authorize from the sign in saved last time, with
+        no network round trips, so the window is ready to
+        go right away. the saved sign in is then checked
+        with gmail in the background.
+        falls back to the authorize thread if there
+        is nothing usable saved
+        '''
+        if not self.auth.start_from_local():
+            self.start_authorize_thread()
+            return
+
+        self.email.service = self.auth.service
+        self._revalidating = True
+        self._authorize_result(True)
+
+        worker = Worker(self.auth.revalidate_profile)
+        worker.signals.result.connect(self._revalidate_result)
+        worker.signals.error.connect(self._revalidate_error)
+        self.threadpool.start(worker)
+
+
+    def _revalidate_result(self, profile):
+        '''
+        the saved sign in checked out with gmail,
+        so anything waiting on the queue can start
+        '''
+        self.setWindowTitle('PyMailList - ' + profile['emailAddress'])
+        self._revalidating = False
+        QTimer.singleShot(0, self._run_queue)
+
+
+    def _revalidate_error(self, e):
+        '''
+        the saved sign in couldn't be checked with gmail.
+        if it was rejected, sign in again. otherwise
+        (e.g. no network) carry on and let the send find out
+        '''
+        from oauth2client.client import AccessTokenRefreshError
+        self._revalidating = False
+        if isinstance(e[1], AccessTokenRefreshError):
+            self.console_log('Saved authorization was rejected, re-authorizing . . .')
+            self._authorized = False
+            self.start_authorize_thread()
+        else:
+            self.console_log('Could not check the saved authorization: ' + str(e[1]))
+            QTimer.singleShot(0, self._run_queue)
+
+
     def _authorize_thread_complete(self):
         '''
         let the people know the the authorize thread completed
@@ -302,55 +504,223 @@ class ApplicationWindow(QMainWindow):
         mb.exec()
 
 
+    def _resume_msg(self, already_sent):
+        '''
+        this message was already sent to some
+        of the contacts; ask the user whether
+        to skip them
+        :return YesNo: int of QMessageBox StandardButtons enum
+        '''
+        mb = QMessageBox()
+        mb.setIcon(QMessageBox.Question)
+        mb.setWindowTitle('Resume Sending')
+        mb.setText(
+            f'This message has already been sent to {already_sent} contacts.\n\n'
+            'Skip them and only send to the rest?')
+        mb.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
+        mb.setDefaultButton(QMessageBox.Yes)
+        YesNo = mb.exec()
+        return YesNo
+
+
+    def _unknown_fields_msg(self, unknown):
+        '''
+        the message has merge fields the contacts
+        don't have; ask the user whether to send
+        it with them left blank
+        :return YesNo: int of QMessageBox StandardButtons enum
+        '''
+        mb = QMessageBox()
+        mb.setIcon(QMessageBox.Warning)
+        mb.setWindowTitle('Unknown Merge Fields')
+        mb.setText(
+            'The contacts have nothing to fill in '
+            f'{", ".join("{" + name + "}" for name in unknown)} with, '
+            'so it will be blank for everyone '
+            '(write {{name}} to send {name} as it is).\n\n'
+            'Send it anyway?')
+        mb.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
+        mb.setDefaultButton(QMessageBox.No)
+        YesNo = mb.exec()
+        return YesNo
+
+
     def send(self):
         '''
-        send the message in the gui
-        to the contacts in the gui
+        queue the message in the gui to send
+        to the contacts in the gui right away
+        (after anything already sending)
+        '''
+        self._queue_message()
+
+
+    def schedule(self):
+        '''
+        queue the message in the gui to send
+        at a later time, or with a priority
         '''
+        chosen = self._schedule_dialog()
+        if chosen is not None:
+            self._queue_message(*chosen)
+
 
-        # we can't send if we are already sending
-        if self._sender_thread_is_running:
-            self.console_log('You\'re already sending messages, silly. Hang on a sec.')
+    def _schedule_dialog(self):
+        '''
+        asks when to send the message, and its priority
+        :return: (start time.time(), priority), or None if cancelled
+        '''
+        dialog = QDialog(self)
+        dialog.setWindowTitle('Schedule Sending')
+        layout = QFormLayout(dialog)
+        start_edit = QDateTimeEdit(QDateTime.currentDateTime().addSecs(60 * 60), dialog)
+        start_edit.setCalendarPopup(True)
+        start_edit.setDisplayFormat('yyyy-MM-dd HH:mm')
+        layout.addRow('Start sending at', start_edit)
+        priority_spin_box = QSpinBox(dialog)
+        priority_spin_box.setRange(-100, 100)
+        priority_spin_box.setToolTip('Campaigns due at the same time send the highest priority first')
+        layout.addRow('Priority', priority_spin_box)
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, parent=dialog)
+        buttons.accepted.connect(dialog.accept)
+        buttons.rejected.connect(dialog.reject)
+        layout.addRow(buttons)
+        if dialog.exec() != QDialog.Accepted:
+            return None
+        return start_edit.dateTime().toSecsSinceEpoch(), priority_spin_box.value()
+
+
+    def _queue_message(self, start_at:float=None, priority:int=0):
+        '''
+        puts the message in the gui on the queue
+        '''
+        # ensure the form is complete
+        if not self._form_complete():
+            self._form_complete_error()
             return
 
+        # make the email from the GUI inputs
+        message = self._make_email()
+
+        # a merge field the contacts don't have would be blank for everyone
+        unknown = unknown_fields(message.merge_fields(), self.contacts.fields)
+        if unknown and self._unknown_fields_msg(unknown) != QMessageBox.Yes:
+            return
+
+        # pick up where the last send of this message left off,
+        # unless told to send it to everyone again
+        journal = SendJournal(self.journal_path, campaign_id(message))
+        already_sent = len(journal.completed())
+        journal.close()
+        resend = bool(already_sent) and self._resume_msg(already_sent) != QMessageBox.Yes
+
+        # only the same message for everyone can be bcc'd
+        bcc_size = self.bcc_size
+        if bcc_size and message.is_personalized():
+            self.console_log('The message has merge fields, so it will be sent to each contact on their own')
+            bcc_size = None
+
+        queued = self.queue.add(message, self.contacts, priority=priority, start_at=start_at,
+                                bcc_size=bcc_size, resend=resend)
+        when = 'now' if start_at is None else time.strftime('%Y-%m-%d %H:%M', time.localtime(start_at))
+        self.console_log(f'Queued "{queued.name}" to send {when} '
+                         f'({len(self.queue.waiting()) - 1} other campaigns waiting)')
+
         # try to authorize yo-self
         if not self._authorized:
-            self.console_log('You\'re not authorized yet! Press the "Authorize" button and try again')
-            #auth_success = self.authorize()
-            #if not auth_success: return
+            self.console_log('You\'re not authorized yet! It will be sent once you press "Authorize"')
             return
+        self._run_queue()
 
-        # ensure the form is complete
-        if not self._form_complete():
-            self._form_complete_error()            
+
+    def _run_queue(self):
+        '''
+        starts sending the next campaign on the queue whose
+        time has come, unless one is sending already
+        '''
+        if (self._sender_thread_is_running or not self._authorized
+                or self._revalidating or self._closing):
+            return
+        queued = self.queue.next_due()
+        if queued is None:
             return
 
-        # make the email from the GUI inputs
-        self._make_email()
+        try:
+            message, contacts = load_campaign(queued)
+        except (OSError, ValueError, UnicodeDecodeError) as e:
+            self.console_log(f'ERROR: Could not load "{queued.name}": {e}')
+            self.queue.set_status(queued.id, CampaignQueue.FAILED, str(e))
+            return
+
+        if queued.status == CampaignQueue.SENDING:
+            self.console_log(f'Carrying on sending "{queued.name}"')
+        else:
+            self.console_log(f'Sending "{queued.name}"')
+        self.queue.set_status(queued.id, CampaignQueue.SENDING)
+        self._queued = queued
+
+        journal = SendJournal(self.journal_path, queued.campaign)
+        skip = skip_for(queued, journal)
 
         # initialize progress bar
-        self._init_progress_bar(pb = self.ui.progress_bar, 
-                                max_val = len(self.contacts))
+        self._init_progress_bar(pb = self.ui.progress_bar,
+                                max_val = len(contacts))
 
         # start email sender thread
-        self._start_sender_thread()
+        self._start_sender_thread(message, contacts, journal, skip, queued.spec['bcc_size'])
 
 
-    def _start_sender_thread(self):
+    def show_queue(self):
+        '''
+        logs the campaigns waiting to send,
+        and offers to cancel the ones not yet started
+        '''
+        waiting = self.queue.waiting()
+        if self.pacer is not None:
+            self.console_log(f'{self.pacer.sent_today()} of the daily limit of '
+                             f'{self.daily_limit} sent in the last 24 hours')
+        if not waiting:
+            self.console_log('No campaigns waiting to send')
+            return
+        for queued in waiting:
+            when = time.strftime('%Y-%m-%d %H:%M', time.localtime(queued.start_at))
+            status = 'sending' if queued.status == CampaignQueue.SENDING else f'from {when}'
+            self.console_log(f'  "{queued.name}" ({status}, priority {queued.priority})')
+
+        if any(queued.status == CampaignQueue.QUEUED for queued in waiting):
+            mb = QMessageBox()
+            mb.setIcon(QMessageBox.Question)
+            mb.setWindowTitle('Campaign Queue')
+            mb.setText('Cancel the campaigns that haven\'t started sending yet?')
+            mb.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
+            mb.setDefaultButton(QMessageBox.No)
+            if mb.exec() == QMessageBox.Yes:
+                self.console_log(f'Cancelled {self.queue.cancel_waiting()} campaigns')
+
+
+    def _start_sender_thread(self, message, contacts, journal=None, skip=frozenset(), bcc_size=None):
         '''
         starts the email sender thread
         '''
         worker = Worker(self.send_runner,
-                        email=self.email,
-                        contacts=self.contacts)
-        worker.kwargs['progress_callback'] = worker.signals.progress
-
-        worker.signals.result.connect(self.console_log)
+                        message=message,
+                        contacts=contacts,
+                        batch_size=self.batch_size,
+                        workers=self.send_workers,
+                        journal=journal,
+                        skip=skip,
+                        bcc_size=bcc_size)
+        worker.kwargs['progress_callback'] = self._progress
+
+        worker.signals.result.connect(self._send_result)
         worker.signals.finished.connect(self._send_thread_complete)
-        worker.signals.error.connect(self._handle_thread_error)
-        worker.signals.progress.connect(self._log_progress)
+        worker.signals.error.connect(self._handle_send_error)
 
         self._sender_thread_is_running = True
+        self._daily_limited = False
+        self._send_error = None
+        self._send_report = None
+        self._last_failure = None
+        self._progress_timer.start()
         self.threadpool.start(worker)
 
 
@@ -363,52 +733,169 @@ class ApplicationWindow(QMainWindow):
         pb.setValue(0)
 
 
-    def _log_progress(self, log=None):
+    def _show_progress(self):
         '''
-        logs the progress of a thread
-        increments progress bar
-        and logs a message
+        shows the progress made since last time:
+        moves the progress bar along and logs
+        all the new lines in one go
         '''
-        self._increment_progress_bar()
-        self.console_log(log)
+        count, lines = self._progress.drain()
+        if count:
+            self._increment_progress_bar(count)
+        if lines:
+            self.console_log('\n'.join(lines))
 
 
-    def send_runner(self, email:Emailer, contacts:list, progress_callback):
+    def send_runner(self, message:Message, contacts, progress_callback:ProgressBuffer,
+                    batch_size:int=1, workers:int=1,
+                    journal:SendJournal=None, skip=frozenset(), bcc_size:int=None):
         '''
-        sends email message individually
+        sends the message individually
         to each contact in contacts list
 
         intended for use with threads so
-        :param progress_callback: can indicate
-        progress
+        :param progress_callback: ProgressBuffer
+        to add the progress to
+        :param batch_size: number of messages to
+        send per batched http request (1 sends
+        each message with its own request)
+        :param workers: number of threads sending
+        at the same time
+        :param contacts: RecipientList or RecipientFile
+        :param journal: SendJournal to record each send in
+        :param skip: (lower case) addresses already sent to
+        :param bcc_size: bcc each message to this many contacts
+        (None sends each contact their own)
+        :return: CampaignReport of what was sent
         '''
-        for address in contacts:
-            email.message.to = address
-            email.message.recreate()
-            sent, e = email.send()
-
+        def _report(envelope, sent, e):
             if sent:
                 status = 'done'
             else:
                 status = f'Error! {str(e)}'
-            progress_callback.emit(f'Just gonna send it to {address} . . . {status}')
+                self._last_failure = e
+                if is_daily_limit_error(e):
+                    self._daily_limited = True
+            progress_callback.add(f'Just gonna send it to {envelope.to} . . . {status}')
+
+        def _skipped(recipient):
+            # still counts towards the progress bar
+            progress_callback.add()
+
+        sender = None
+        if self.send_engine == 'asyncio':
+            # runs its own event loop on this worker thread
+            sender = AsyncEmailer(self.auth.access_token,
+                                  connections=self.send_connections,
+                                  concurrency=2 * self.send_connections,
+                                  limiter=self.limiter, pacer=self.pacer)
+
+        prerenderer = None
+        if (self.prerender_workers is not None and not bcc_size
+                and message.is_personalized()):
+            prerenderer = Prerenderer(message, workers=self.prerender_workers or None,
+                                      chunk_size=batch_size)
+
+        return send_campaign(message, contacts, self.auth.build_service,
+                             _report, _skipped,
+                             batch_size=batch_size, workers=workers,
+                             limiter=self.limiter, journal=journal, skip=skip,
+                             sender=sender, bcc_size=bcc_size,
+                             prerenderer=prerenderer, pacer=self.pacer)
 
 
     def _handle_thread_error(self, e):
         '''
         takes the worker thread error and
-        processes it for the gui
+        logs it to the gui
         '''
         self.console_log('ERROR: ' + str(e[1]))
 
 
+    def _handle_send_error(self, e):
+        '''
+        the sender thread failed, so the
+        campaign it was sending failed too
+        '''
+        self._handle_thread_error(e)
+        self._send_error = e[1]
+
+
+    def _send_result(self, report):
+        '''
+        logs how the send went, after
+        the last of its progress
+        '''
+        self._show_progress()
+        self.console_log(report)
+        self._send_report = report
+
+
     def _send_thread_complete(self):
         '''
         display message once the thread that sends all the
         messages finishes up
         '''
+        self._progress_timer.stop()
+        self._show_progress()
         self._sender_thread_is_running = False
         self.console_log('Email sender thread completed.')
+        self._write_metrics()
+
+        queued, self._queued = self._queued, None
+        if queued is not None:
+            self._finish_queued(queued)
+        # then on to the next campaign
+        QTimer.singleShot(0, self._run_queue)
+
+
+    def _finish_queued(self, queued):
+        '''
+        takes a campaign that has finished sending off the
+        queue, or puts it back if it has more to send
+        '''
+        if self._closing:
+            # so it carries on next time
+            return
+        if self._send_error is not None:
+            self.queue.set_status(queued.id, CampaignQueue.FAILED, str(self._send_error))
+        elif self._daily_limited:
+            # gmail counted more than the pacer did (e.g. sends from
+            # elsewhere), so try the rest again in a while
+            self.queue.set_status(queued.id, CampaignQueue.QUEUED, 'hit the daily sending limit',
+                                  start_at=time.time() + 60 * 60)
+            self.console_log(f'Hit the daily sending limit, "{queued.name}" will carry on in an hour')
+        elif self._send_report is not None and self._send_report.failed and not self._send_report.sent:
+            # e.g. the sign in was revoked, so nothing was delivered
+            detail = f'every send failed: {self._last_failure}'
+            self.queue.set_status(queued.id, CampaignQueue.FAILED, detail)
+            self.console_log(f'"{queued.name}" failed, {detail}')
+        else:
+            self.queue.set_status(queued.id, CampaignQueue.DONE)
+
+
+    def closeEvent(self, event):
+        '''
+        stops waiting on the daily limit so a paced send winds
+        down. it carries on from the journal next time
+        '''
+        self._closing = True
+        if self.pacer is not None:
+            self.pacer.stop()
+        self._queue_timer.stop()
+        super().closeEvent(event)
+
+
+    def _write_metrics(self):
+        '''
+        saves the metrics so far, if there is somewhere to
+        '''
+        if not self.metrics_path:
+            return
+        try:
+            REGISTRY.write(self.metrics_path)
+        except OSError as e:
+            self.console_log(f'ERROR: Could not write the metrics: {e}')
 
 
     def console_log(self, s):
@@ -417,14 +904,14 @@ class ApplicationWindow(QMainWindow):
         logs whatever is passed to it
         to the gui console
         '''
-        if s is not None: self.ui.console.append(str(s))
+        if s is not None: self.ui.console.appendPlainText(str(s))
 
 
-    def _increment_progress_bar(self):
+    def _increment_progress_bar(self, count:int=1):
         '''
-        increments progress bar by 1
+        increments progress bar by count
         '''
-        self.ui.progress_bar.setValue(self.ui.progress_bar.value() + 1)
+        self.ui.progress_bar.setValue(self.ui.progress_bar.value() + count)
 
 
     def _form_complete(self):
@@ -455,7 +942,8 @@ class ApplicationWindow(QMainWindow):
             sender='me',
             subject=self.subject,
             body=self.body,
-            body_type=self.body_type
+            body_type=self.body_type,
+            attachments=self.attachments
             )
         return self.email.message
 
@@ -495,16 +983,179 @@ class ApplicationWindow(QMainWindow):
     @property
     def contacts(self):
         '''
-        returns a list of the
+        returns the RecipientList of the
         contacts in the gui
+        (only re-read when the contacts are edited)
+        or the RecipientFile of imported contacts
+        '''
+        if self._contacts_file is not None:
+            return self._contacts_file
+        if self._contacts is None:
+            self._contacts = self.contacts_model.recipients()
+        return self._contacts
+
+
+    def _contacts_changed(self):
+        '''
+        forget the parsed contacts so
+        they are re-read next time
+        '''
+        self._contacts = None
+        # typing in contacts replaces the imported ones
+        if self._contacts_file is not None and len(self.contacts_model):
+            self._forget_contacts_file()
+        self._contacts_status_timer.start()
+
+
+    def _update_contacts_status(self):
+        '''
+        shows how many contacts there are
+        '''
+        if self._contacts_file is not None:
+            text = f'Sending to the contacts in {self._contacts_file.path}'
+        elif not len(self.contacts_model):
+            text = 'No contacts'
+        else:
+            # not the cleaned up count, which means parsing the
+            # whole list (invalid and repeated rows are shown in colour)
+            text = f'{len(self.contacts_model):,} contacts'
+            if self.contacts_model.is_filtered():
+                text += f'. Showing {self.contacts_model.rowCount():,}'
+        self.ui.contacts_status_label.setText(text)
+
+
+    def _setup_contacts_actions(self):
+        '''
+        the contacts list's right click menu and shortcuts
+        '''
+        view = self.ui.contacts_list_view
+        for text, shortcut, slot in (
+                ('Paste', QKeySequence.Paste, self.paste_contacts),
+                ('Copy', QKeySequence.Copy, self.copy_contacts),
+                ('Delete', QKeySequence.Delete, self.delete_contacts)):
+            action = QAction(text, view)
+            action.setShortcut(shortcut)
+            action.setShortcutContext(Qt.WidgetShortcut)
+            action.triggered.connect(slot)
+            view.addAction(action)
+
+
+    def _selected_contact_rows(self):
+        return [index.row() for index in self.ui.contacts_list_view.selectionModel().selectedRows()]
+
+
+    def paste_contacts(self):
+        '''
+        adds the contacts on the clipboard
+        (one per line, or separated by commas or semicolons)
+        '''
+        added = self.contacts_model.add_text(QApplication.clipboard().text())
+        self.console_log(f'Added {added:,} contacts')
+
+
+    def copy_contacts(self):
+        '''
+        copies the selected contacts, one per line
+        '''
+        model = self.contacts_model
+        rows = sorted(self._selected_contact_rows())
+        QApplication.clipboard().setText(
+            '\n'.join(model.data(model.index(row)) for row in rows))
+
+
+    def delete_contacts(self):
+        rows = self._selected_contact_rows()
+        self.contacts_model.remove_rows(rows)
+        self.console_log(f'Removed {len(rows):,} contacts')
+
+
+    def add_typed_contacts(self):
+        '''
+        adds what was typed above the contacts
+        '''
+        if self.contacts_model.add_text(self.ui.contacts_line_edit.text()):
+            self.ui.contacts_line_edit.clear()
+
+
+    def _filter_contacts(self):
+        self.contacts_model.set_filter(self.ui.contacts_line_edit.text(),
+                                       self.ui.contacts_problems_check_box.isChecked())
+        self._contacts_status_timer.start()
+
+
+    def import_contacts(self):
+        '''
+        asks for a csv or tsv file of contacts to send to.
+        the file is read as the messages are sent
+        rather than loaded into the gui.
+        a text file of one address per line is
+        loaded into the contacts list instead
+        '''
+        file_path, _ = QFileDialog.getOpenFileName(
+            self, 'Import Contacts', '',
+            'Contacts (*.csv *.tsv *.txt);;All Files (*)')
+        if not file_path:
+            return
+
+        if Path(file_path).suffix.lower() == '.txt':
+            try:
+                with open(file_path, encoding='utf-8-sig') as f:
+                    self.contacts_model.set_text(f.read())
+            except (OSError, UnicodeDecodeError) as e:
+                self.console_log(f'ERROR: Could not import contacts: {e}')
+                return
+            self.console_log(f'Loaded {len(self.contacts_model):,} contacts from {file_path}')
+            return
+
+        try:
+            contacts_file = RecipientFile(file_path)
+        except (OSError, ValueError, UnicodeDecodeError) as e:
+            self.console_log(f'ERROR: Could not import contacts: {e}')
+            return
+
+        self.contacts_model.clear()
+        self._contacts_file = contacts_file
+        self._update_contacts_status()
+        self.console_log(
+            f'Imported contacts from {file_path} '
+            f'(email column "{contacts_file.email_column}", '
+            f'merge fields {", ".join("{" + name + "}" for name in contacts_file.fields) or "none"})')
+
+
+    def _forget_contacts_file(self):
+        '''
+        go back to sending to the
+        contacts typed into the gui
+        '''
+        self._contacts_file = None
+        self._contacts_status_timer.start()
+
+
+    def attach_files(self):
+        '''
+        asks for files to attach to the message.
+        they are only read when the message is sent
         '''
-        return self.ui.contacts_text_edit.toPlainText().split('\n')
+        file_paths, _ = QFileDialog.getOpenFileNames(
+            self, 'Attach Files', '', 'All Files (*)')
+        for file_path in file_paths:
+            attachment = Attachment(file_path)
+            try:
+                size = attachment.size
+            except OSError as e:
+                self.console_log(f'ERROR: Could not attach {file_path}: {e}')
+                continue
+            self.attachments.append(attachment)
+            self.console_log(f'Attached {attachment.filename} ({size / 1024:,.0f} KB)')
 
 
     def clear(self):
         self.ui.message_text_edit.clear()
-        self.ui.contacts_text_edit.clear()
+        self.ui.contacts_line_edit.clear()
+        self.contacts_model.clear()
         self.ui.subject_line_edit.clear()
+        self._forget_contacts_file()
+        self.attachments = []
         self.console_log('Fields Cleared')
 
 
@@ -567,4 +1218,7 @@ def main():
     sys.exit(app.exec_())
 
 if __name__ == "__main__":
+    # the pre-rendering processes start by running this
+    # file again, which a frozen exe needs told about
+    multiprocessing.freeze_support()
     main()
\ No newline at end of file
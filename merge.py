@@ -0,0 +1,83 @@
+# for the mail merge templates
+import re
+from collections import namedtuple
+from html import escape
+
+
+# someone to send to, along with the values
+# for their merge fields (e.g. {'first_name': 'Bob'})
+Recipient = namedtuple('Recipient', ['address', 'fields'])
+
+
+class MergeTemplate:
+    '''
+    Text with {field} placeholders that are filled in
+    for each recipient.
+
+    The text is parsed once, into a %-style format string,
+    so filling it in is a single C level string format.
+    Only {name} (letters, digits and underscores) is a field,
+    any other braces are left alone so css in html bodies
+    doesn't need escaping. Doubled braces are literal
+    braces, so {{name}} comes out as {name}
+    '''
+
+    FIELD = re.compile(r'\{\{([^{}]*)\}\}|\{([A-Za-z_][A-Za-z0-9_]*)\}')
+
+    def __init__(self, text:str, html:bool=False):
+        '''
+        :param text: the template text
+        :param html: whether to html escape field values
+        '''
+        self.text = text
+        self.html = html
+
+        # split gives literal, escaped, name, literal, escaped, name, ..., literal
+        # (escaped or name is None, depending on which one matched)
+        parts = self.FIELD.split(text)
+        self.names = tuple(sorted({name for name in parts[2::3] if name is not None}))
+        format_parts = []
+        literal_parts = []
+        for i in range(0, len(parts), 3):
+            literal = parts[i]
+            if i + 2 < len(parts):
+                escaped, name = parts[i + 1], parts[i + 2]
+                if escaped is not None:
+                    literal += '{' + escaped + '}'
+            else:
+                name = None
+            format_parts.append(literal.replace('%', '%%'))
+            literal_parts.append(literal)
+            if name is not None:
+                format_parts.append(f'%({name})s')
+        self._format = ''.join(format_parts)
+        # the text with the doubled braces undone, when there are no fields
+        self._literal = ''.join(literal_parts)
+
+    @property
+    def has_fields(self):
+        return len(self.names) > 0
+
+    def render(self, fields:dict):
+        '''
+        fills in the template
+        fields the recipient doesn't have are left blank
+        '''
+        if not self.names:
+            return self._literal
+        if self.html:
+            values = {name: escape(str(fields.get(name, ''))) for name in self.names}
+        else:
+            values = {name: fields.get(name, '') for name in self.names}
+        return self._format % values
+
+
+def unknown_fields(names, fields):
+    '''
+    the names (e.g. a template's) that aren't among the
+    contacts' merge fields, so would be blank for everyone
+    :param fields: the contacts' merge field names
+                   ({email} is always one of them)
+    :return: sorted list of the unknown names
+    '''
+    return sorted(set(names) - set(fields) - {'email'})
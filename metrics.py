@@ -0,0 +1,342 @@
+# for the metrics
+import json
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+from os import replace
+
+
+# bucket upper bounds, in seconds
+API_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+RENDER_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 0.01, 0.05, 0.25)
+AUTH_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _label_text(names, values, extra=()):
+    '''
+    the {name="value",...} part of a prometheus sample
+    '''
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def error_class(e):
+    '''
+    a short name for what went wrong, for labelling metrics
+    e.g. 'HttpError 429' or 'ConnectionResetError'
+    '''
+    status = getattr(getattr(e, 'resp', None), 'status', None)
+    name = type(e).__name__
+    return name if status is None else f'{name} {status}'
+
+
+class Metric:
+    '''
+    A named value (or one per set of label values).
+    Safe to update from any thread
+    '''
+
+    kind = None
+
+    def __init__(self, name:str, help:str, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.label_names):
+            raise ValueError(f'{self.name} needs the labels {self.label_names}')
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def labels(self, **labels):
+        '''
+        the metric for one set of label values, which is
+        quicker to update in a hot loop than passing them every time
+        '''
+        return _Bound(self, self._key(labels))
+
+    def samples(self):
+        '''
+        a copy of {label values: value}
+        '''
+        with self._lock:
+            return dict(self._values)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class _Bound:
+    '''
+    a metric with its label values filled in
+    '''
+
+    def __init__(self, metric, key):
+        self.metric = metric
+        self.key = key
+
+    def inc(self, amount:float=1):
+        self.metric._inc(self.key, amount)
+
+    def dec(self, amount:float=1):
+        self.metric._inc(self.key, -amount)
+
+    def set(self, value:float):
+        self.metric._set(self.key, value)
+
+    def observe(self, value:float):
+        self.metric._observe(self.key, value)
+
+    @contextmanager
+    def time(self):
+        '''
+        observes how long a with block takes
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.metric._observe(self.key, time.perf_counter() - start)
+
+
+class Counter(Metric):
+    '''
+    A count that only goes up
+    '''
+
+    kind = 'counter'
+
+    def inc(self, amount:float=1, **labels):
+        self._inc(self._key(labels), amount)
+
+    def _inc(self, key, amount):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    '''
+    A value that goes up and down
+    '''
+
+    kind = 'gauge'
+
+    def dec(self, amount:float=1, **labels):
+        self._inc(self._key(labels), -amount)
+
+    def set(self, value:float, **labels):
+        self._set(self._key(labels), value)
+
+    def _set(self, key, value):
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    '''
+    Counts of observations (e.g. how long something
+    took) in buckets, plus their count and sum
+    '''
+
+    kind = 'histogram'
+
+    def __init__(self, name:str, help:str, labels=(), buckets=API_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value:float, **labels):
+        self._observe(self._key(labels), value)
+
+    def _observe(self, key, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # a count for each bucket plus +Inf, then the count and sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0, 0.0]
+            counts[index] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        '''
+        observes how long a with block takes, e.g.
+            with API_SECONDS.time(method='messages.send'):
+                ...
+        '''
+        return self.labels(**labels).time()
+
+    def samples(self):
+        with self._lock:
+            return {key: list(counts) for key, counts in self._values.items()}
+
+
+class Registry:
+    '''
+    All the metrics, which can be written out as
+    a prometheus text file or a json snapshot
+    '''
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _add(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f'{name} is already a {metric.kind}')
+            return metric
+
+    def counter(self, name:str, help:str, labels=()):
+        return self._add(Counter, name, help, labels)
+
+    def gauge(self, name:str, help:str, labels=()):
+        return self._add(Gauge, name, help, labels)
+
+    def histogram(self, name:str, help:str, labels=(), buckets=API_BUCKETS):
+        return self._add(Histogram, name, help, labels, buckets=buckets)
+
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def clear(self):
+        '''
+        zeroes every metric (e.g. between campaigns)
+        '''
+        for metric in self.metrics():
+            metric.clear()
+
+    def prometheus(self):
+        '''
+        every metric in the prometheus text format
+        '''
+        lines = []
+        for metric in self.metrics():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for key, value in sorted(metric.samples().items()):
+                if metric.kind != 'histogram':
+                    lines.append(f'{metric.name}{_label_text(metric.label_names, key)} {_number(value)}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float('inf'),), value):
+                    cumulative += count
+                    labels = _label_text(metric.label_names, key, [('le', _number(bound))])
+                    lines.append(f'{metric.name}_bucket{labels} {cumulative}')
+                labels = _label_text(metric.label_names, key)
+                lines.append(f'{metric.name}_sum{labels} {_number(value[-1])}')
+                lines.append(f'{metric.name}_count{labels} {value[-2]}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        '''
+        every metric as a dictionary, ready for json
+        '''
+        snapshot = {}
+        for metric in self.metrics():
+            samples = []
+            for key, value in sorted(metric.samples().items()):
+                sample = {'labels': dict(zip(metric.label_names, key))}
+                if metric.kind == 'histogram':
+                    count, total = value[-2], value[-1]
+                    sample.update(
+                        count=count, sum=total, mean=total / count if count else None,
+                        buckets={_number(bound): n for bound, n
+                                 in zip(metric.buckets + (float('inf'),), value)})
+                else:
+                    sample['value'] = value
+                samples.append(sample)
+            snapshot[metric.name] = {'type': metric.kind, 'help': metric.help,
+                                     'samples': samples}
+        return {'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'metrics': snapshot}
+
+    def write(self, file_path:str):
+        '''
+        writes the metrics to a file, as json if it ends in .json
+        and prometheus text otherwise (e.g. for node_exporter's
+        textfile collector, which wants files ending in .prom).
+        it is written to a temporary file first, so a half
+        written file is never read
+        '''
+        if file_path.lower().endswith('.json'):
+            text = json.dumps(self.snapshot(), indent=2)
+        else:
+            text = self.prometheus()
+        temp_path = file_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        replace(temp_path, file_path)
+
+
+# the metrics for the whole app
+REGISTRY = Registry()
+
+SENDS = REGISTRY.counter(
+    'pymaillist_sends_total', 'Messages sent, by result and error class',
+    ('result', 'error'))
+RATE_LIMITED = REGISTRY.counter(
+    'pymaillist_rate_limited_total', 'Api calls gmail rate limited, to be retried')
+API_SECONDS = REGISTRY.histogram(
+    'pymaillist_api_seconds', 'Time spent in gmail api requests, by method',
+    ('method',), buckets=API_BUCKETS)
+RENDER_SECONDS = REGISTRY.histogram(
+    'pymaillist_render_seconds', 'Time to render a message for one recipient, '
+    'by whether it was spliced from a shared template or merged in full',
+    ('kind',), buckets=RENDER_BUCKETS)
+AUTH_SECONDS = REGISTRY.histogram(
+    'pymaillist_auth_seconds', 'Time spent authorizing, by step',
+    ('step',), buckets=AUTH_BUCKETS)
+AUTH_FAILURES = REGISTRY.counter(
+    'pymaillist_auth_failures_total', 'Authorization steps that failed, by step',
+    ('step',))
+SEND_QUEUE = REGISTRY.gauge(
+    'pymaillist_send_queue', 'Messages handed to the senders and not yet finished')
+
+
+_SENT = SENDS.labels(result='sent', error='')
+
+
+def count_send(e=None):
+    '''
+    counts a message as sent, or as failed with the error e
+    '''
+    if e is None:
+        _SENT.inc()
+    else:
+        SENDS.inc(result='failed', error=error_class(e))
+
+
+@contextmanager
+def auth_step(step:str):
+    '''
+    times a step of authorizing, and counts it if it fails
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        AUTH_FAILURES.inc(step=step)
+        raise
+    finally:
+        AUTH_SECONDS.observe(time.perf_counter() - start, step=step)
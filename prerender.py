@@ -0,0 +1,113 @@
+# for pre-rendering messages in other processes
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+
+from gmail import Envelope
+from metrics import RENDER_SECONDS
+from sender import chunks
+
+
+_RENDER_MERGED = RENDER_SECONDS.labels(kind='merged')
+
+# the template each worker process renders from,
+# sent to it once when the process starts
+# (without the shared part, see MessageTemplate.heads_only)
+_template = None
+
+
+def _start_worker(template):
+    global _template
+    _template = template
+
+
+def _render_chunk(recipients):
+    '''
+    renders and encodes the head of the message for
+    a chunk of (address, fields) in a worker process.
+    only the heads come back, as the shared part (e.g.
+    the attachments) is the same for everyone
+    :return: (list of (encoded head, offset) as from
+             MessageTemplate.encode_head, list of seconds each took)
+    '''
+    heads = []
+    seconds = []
+    for address, fields in recipients:
+        start = time.perf_counter()
+        heads.append(_template.encode_head(_template.head(address, fields)))
+        seconds.append(time.perf_counter() - start)
+    return heads, seconds
+
+
+class Prerenderer:
+    '''
+    Renders each recipient's message in a pool of processes,
+    ahead of the senders.
+
+    Merging and base64 encoding a personalized message is
+    pure python and holds the gil, so rendering in the sending
+    process slows down the threads doing the sending. Here the
+    template is sent to each worker process once, recipients go
+    to them in chunks, and only a few chunks are rendered ahead
+    so a huge list is never all held in memory. The workers only
+    send back each message's encoded head, and the shared part
+    (e.g. the attachments) is put after it here as each envelope
+    is handed on, so what is waiting is small however big the
+    attachments are. The envelopes come out in the same order
+    as the recipients went in.
+
+    A message without merge fields is only spliced together,
+    which is quicker than sending it between processes, so
+    it is not worth pre-rendering
+    '''
+
+    def __init__(self, message, workers:int=None, chunk_size:int=100, ahead:int=None):
+        '''
+        :param message: gmail.Message to render
+        :param workers: number of processes (the number of cpus if not given)
+        :param chunk_size: recipients sent to a process at once
+        :param ahead: most chunks rendering or rendered and waiting
+                      to be sent (twice the workers if not given)
+        '''
+        self.message = message
+        self.workers = max(1, workers or cpu_count() or 1)
+        self.chunk_size = max(1, chunk_size)
+        self.ahead = max(1, ahead or self.workers * 2)
+
+    def envelopes(self, recipients):
+        '''
+        yields an Envelope for each recipient, rendered in
+        the worker processes. the pool is shut down once
+        they have all been rendered (or the caller stops early)
+
+        :param recipients: iterable of merge.Recipient, read lazily
+        '''
+        template = self.message.template()
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_start_worker,
+                                 initargs=(template.heads_only(),)) as executor:
+            try:
+                for chunk in chunks(recipients, self.chunk_size):
+                    addresses = [address for address, _ in chunk]
+                    pending.append((addresses, executor.submit(_render_chunk, chunk)))
+                    # wait for the oldest chunk once enough are under way
+                    if len(pending) >= self.ahead:
+                        yield from self._finish(template, *pending.popleft())
+                while pending:
+                    yield from self._finish(template, *pending.popleft())
+            finally:
+                for _, future in pending:
+                    future.cancel()
+
+    @staticmethod
+    def _finish(template, addresses, future):
+        heads, seconds = future.result()
+        # the render times are recorded here, as the
+        # worker processes' metrics are never seen
+        for value in seconds:
+            _RENDER_MERGED.observe(value)
+        sender = template.sender
+        encoded = template.encoded
+        for address, (head, offset) in zip(addresses, heads):
+            yield Envelope(address, sender, {'raw': (head + encoded[offset]).decode()})
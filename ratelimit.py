@@ -0,0 +1,182 @@
+# for the rate limiter
+import json
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+
+# what gmail charges for each api method, in quota units
+# https://developers.google.com/gmail/api/reference/quota
+QUOTA_COSTS = {
+    'messages.send': 100,
+    'getProfile': 1,
+}
+
+# gmail's per-user limit, in quota units per second
+USER_QUOTA_RATE = 250
+
+# the reasons gmail gives when it wants us to slow down
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+# the reasons gmail gives when an account can't send any more today
+DAILY_LIMIT_REASONS = ('dailyLimitExceeded', 'quotaExceeded')
+
+# what gmail says when an account has hit its daily sending limit,
+# which can come with a rate limit reason
+DAILY_LIMIT_MESSAGES = ('daily limit', 'daily user sending quota', 'sending limit')
+
+
+def _error(e):
+    '''
+    the error out of the json body
+    of a googleapiclient HttpError
+    '''
+    try:
+        error = json.loads(e.content.decode('utf-8'))['error']
+    except (AttributeError, ValueError, KeyError, TypeError):
+        return {}
+    return error if isinstance(error, dict) else {}
+
+
+def _error_reasons(e):
+    '''
+    gets the list of error reasons out of
+    the json body of a googleapiclient HttpError
+    '''
+    return [err.get('reason') for err in _error(e).get('errors', [])
+            if isinstance(err, dict)]
+
+
+def is_daily_limit_error(e):
+    '''
+    returns true if the error is gmail saying the account
+    has sent all it can for the day (so there is no point
+    trying again until tomorrow)
+    '''
+    status = getattr(getattr(e, 'resp', None), 'status', None)
+    if status not in (403, 429):
+        return False
+    if any(reason in DAILY_LIMIT_REASONS for reason in _error_reasons(e)):
+        return True
+    message = str(_error(e).get('message', '')).lower()
+    return any(text in message for text in DAILY_LIMIT_MESSAGES)
+
+
+def is_rate_error(e):
+    '''
+    returns true if the error is gmail telling
+    us we are sending too fast
+    (429, or a 403 with a rate limit reason),
+    but not that we have hit the daily limit
+    '''
+    status = getattr(getattr(e, 'resp', None), 'status', None)
+    if status in (403, 429) and is_daily_limit_error(e):
+        return False
+    if status == 429:
+        return True
+    if status == 403:
+        return any(reason in RATE_LIMIT_REASONS for reason in _error_reasons(e))
+    return False
+
+
+def retry_after(e):
+    '''
+    gets the number of seconds out of the Retry-After
+    header of an HttpError (which can be either a number
+    of seconds or an http date)
+    returns None if there isn't one
+    '''
+    resp = getattr(e, 'resp', None)
+    if resp is None:
+        return None
+    value = resp.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class QuotaLimiter:
+    '''
+    Token bucket that hands out gmail quota units.
+
+    Every api call acquires its quota cost before it is made.
+    When gmail complains about the rate, the refill rate is cut
+    back (and paused for Retry-After if given), and every success
+    nudges it back up towards the maximum.
+    Safe to share between sender threads
+    '''
+
+    def __init__(self, max_rate:float=USER_QUOTA_RATE, min_rate:float=None,
+                 increase:float=1.0, decrease:float=0.5):
+        '''
+        :param max_rate: the most quota units per second to ever allow
+        :param min_rate: the least quota units per second to back off to
+                         (defaults to one message a second)
+        :param increase: units per second added to the rate for each success
+        :param decrease: fraction of the rate kept after a rate error
+        '''
+        self.max_rate = max_rate
+        self.min_rate = min_rate or min(max_rate, QUOTA_COSTS['messages.send'])
+        self.increase = increase
+        self.decrease = decrease
+
+        # start just under the quota and work up to it
+        self.rate = max(self.min_rate, 0.9 * max_rate)
+        self._tokens = self.rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        '''
+        adds the tokens earned since the last refill
+        (call while holding the lock)
+        '''
+        now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def reserve(self, units:float):
+        '''
+        takes units out of the bucket without waiting
+        callers are served in the order they ask
+        :return: seconds to wait before using them
+        '''
+        with self._lock:
+            self._refill()
+            self._tokens -= units
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+    def acquire(self, units:float):
+        '''
+        takes units out of the bucket, blocking until
+        they would have been available
+        '''
+        wait = self.reserve(units)
+        if wait > 0:
+            time.sleep(wait)
+
+    def success(self):
+        '''
+        an api call went through, so speed up a bit
+        '''
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def backoff(self, delay:float=None):
+        '''
+        gmail said we are going too fast, so slow down
+        :param delay: seconds that nobody should send for
+                      (i.e. the Retry-After header)
+        '''
+        with self._lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            # going into debt makes every caller wait it out
+            self._tokens = min(self._tokens, 0) - (delay or 0) * self.rate
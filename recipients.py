@@ -0,0 +1,302 @@
+# for the recipient list
+import re
+from array import array
+from collections import namedtuple
+from itertools import accumulate
+
+# for the recipient file
+import csv
+from os import path
+
+from merge import Recipient
+
+
+# a pragmatic check of an address: something@domain.tld
+ADDRESS = (r"[A-Za-z0-9.!#$%&'*+/=?^_`{|}~-]+"
+           r"@[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?"
+           r"(?:\.[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?)+")
+
+# what gets stripped off either side of an address
+# (whitespace, and separators pasted in from other mail clients)
+PADDING = r'[ \t\r\f\v,;]*'
+
+_ADDRESS = re.compile(PADDING + '(' + ADDRESS + ')' + PADDING)
+_ADDRESS_LINE = re.compile('^' + PADDING + '(' + ADDRESS + ')' + PADDING + '$', re.MULTILINE)
+_BLANK_LINE = re.compile('^' + PADDING + '$', re.MULTILINE)
+
+
+def is_valid(address:str):
+    '''
+    returns true if the address looks
+    like an email address
+    '''
+    return _ADDRESS.fullmatch(address) is not None
+
+
+class CleanReport(namedtuple('CleanReport', ['blank', 'invalid', 'duplicate', 'kept'])):
+    '''
+    counts of what happened to the contacts
+    when they were cleaned up
+    '''
+
+    def __str__(self):
+        return (f'{self.kept} contacts to send to '
+                f'(dropped {self.blank} blank, {self.invalid} invalid '
+                f'and {self.duplicate} duplicate)')
+
+
+class RecipientCleaner:
+    '''
+    Normalizes, validates and de-duplicates recipients
+    one at a time, on their way to the sender.
+
+    Addresses have whitespace and separators stripped,
+    ones that aren't valid are dropped, and repeats are
+    dropped (ignoring case). The counts are kept in report
+    '''
+
+    def __init__(self):
+        self._seen = set()
+        self.blank = 0
+        self.invalid = 0
+        self.duplicate = 0
+        self.kept = 0
+
+    @property
+    def report(self):
+        return CleanReport(self.blank, self.invalid, self.duplicate, self.kept)
+
+    def clean(self, recipients):
+        '''
+        yields the recipients worth sending to,
+        with their addresses normalized
+        '''
+        seen = self._seen
+        fullmatch = _ADDRESS.fullmatch
+        for recipient in recipients:
+            match = fullmatch(recipient.address)
+            if match is None:
+                if recipient.address.strip(' \t\r\f\v,;'):
+                    self.invalid += 1
+                else:
+                    self.blank += 1
+                continue
+            address = match.group(1)
+            key = address.lower()
+            if key in seen:
+                self.duplicate += 1
+                continue
+            seen.add(key)
+            self.kept += 1
+            yield recipient._replace(address=address)
+
+
+class RecipientList:
+    '''
+    The contacts, parsed once and stored compactly.
+
+    Rather than a python list of strings, all the addresses
+    live in one string, with an array of where each one starts.
+    Iterating over it hands out one address at a time
+    '''
+
+    # there are no merge fields besides {email}
+    fields = {}
+
+    def __init__(self, text:str=''):
+        '''
+        :param text: the contacts, one per line.
+                     blank, invalid and repeated lines are dropped
+                     (what was dropped is counted in report)
+        '''
+        kept, self.report = self._clean(text)
+
+        self._text = '\n'.join(kept)
+
+        # starting offset of each address, plus one past the end
+        # of the text so every address ends at the next start - 1
+        self._starts = array('L', accumulate(map((1).__add__, map(len, kept)), initial=0))
+
+    @staticmethod
+    def _clean(text):
+        '''
+        normalizes, validates and de-duplicates all the contacts at once.
+        each step is a single pass over the whole text in C (regex
+        scans, lower and dict building) rather than a python loop
+        :return: (list of addresses to keep, CleanReport)
+        '''
+        text = text.rstrip('\r\n')
+        if not text:
+            return [], CleanReport(0, 0, 0, 0)
+
+        lines = text.count('\n') + 1
+        blank = len(_BLANK_LINE.findall(text))
+        valid = _ADDRESS_LINE.findall(text)
+        invalid = lines - blank - len(valid)
+
+        # case-insensitive keys, but keep the address as first written
+        keys = '\n'.join(valid).lower().split('\n') if valid else []
+        first = dict(zip(reversed(keys), reversed(valid)))
+        if len(first) == len(valid):
+            kept = valid
+        else:
+            kept = list(map(first.__getitem__, dict.fromkeys(keys)))
+
+        return kept, CleanReport(blank, invalid, len(valid) - len(kept), len(kept))
+
+    def __len__(self):
+        return len(self._starts) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('recipient index out of range')
+        return self._text[self._starts[index]:self._starts[index + 1] - 1]
+
+    def __iter__(self):
+        text = self._text
+        starts = self._starts
+        for i in range(len(starts) - 1):
+            yield text[starts[i]:starts[i + 1] - 1]
+
+    def recipients(self):
+        '''
+        yields a Recipient for each address
+        (there are no merge fields besides {email})
+        '''
+        for address in self:
+            yield Recipient(address, None)
+
+
+def field_name(column:str):
+    '''
+    turns a column heading into a merge field name
+    e.g. 'First Name' -> 'first_name'
+    '''
+    return '_'.join(column.strip().lower().replace('-', ' ').split())
+
+
+class RecipientFile:
+    '''
+    Contacts in a csv or tsv file, read straight from disk.
+
+    Rows are read one at a time as they are sent, so the
+    file can be far larger than memory. The email column
+    gives the address and the other columns become merge
+    fields named after their headings
+    '''
+
+    # read the file a megabyte at a time
+    BUFFER_SIZE = 1 << 20
+
+    # headings that are taken to be the email column
+    EMAIL_COLUMNS = ('email', 'e_mail', 'email_address', 'e_mail_address', 'address')
+
+    def __init__(self, file_path, email_column:str=None, fields:dict=None,
+                 delimiter:str=None, encoding:str='utf-8-sig'):
+        '''
+        :param file_path: the csv/tsv file. the first row must be headings
+        :param email_column: heading of the email column
+                             (found from EMAIL_COLUMNS if not given)
+        :param fields: {merge field name: column heading} to use
+                       (every other column if not given)
+        :param delimiter: the column separator
+                          (tab for .tsv/.tab files, otherwise sniffed)
+        '''
+        self.path = file_path
+        self.encoding = encoding
+        self.delimiter = delimiter or self._find_delimiter()
+        self.columns = self._read_columns()
+        self.email_column = email_column or self._find_email_column()
+        if self.email_column not in self.columns:
+            raise ValueError(f'No "{self.email_column}" column in {self.path}')
+        if fields is None:
+            fields = {field_name(column): column for column in self.columns
+                      if column != self.email_column}
+        self.fields = fields
+        self._length = None
+        self._cleaner = RecipientCleaner()
+
+    def _open(self):
+        return open(self.path, newline='', encoding=self.encoding,
+                    buffering=self.BUFFER_SIZE)
+
+    def _find_delimiter(self):
+        '''
+        works out what separates the columns
+        from the extension or a sample of the file
+        '''
+        if path.splitext(self.path)[1].lower() in ('.tsv', '.tab'):
+            return '\t'
+        with self._open() as f:
+            sample = f.read(64 * 1024)
+        try:
+            return csv.Sniffer().sniff(sample, delimiters=',;\t|').delimiter
+        except csv.Error:
+            return ','
+
+    def _read_columns(self):
+        with self._open() as f:
+            return [column.strip() for column in next(csv.reader(f, delimiter=self.delimiter), [])]
+
+    def _find_email_column(self):
+        for column in self.columns:
+            if field_name(column) in self.EMAIL_COLUMNS:
+                return column
+        raise ValueError(f'Could not find an email column in {self.path}')
+
+    def __len__(self):
+        '''
+        the number of rows, not counting the headings.
+        it is counted from line breaks, so a quoted value
+        spanning lines makes it an over-estimate
+        '''
+        if self._length is None:
+            lines = 0
+            last = b'\n'
+            with open(self.path, 'rb') as f:
+                for chunk in iter(lambda: f.read(self.BUFFER_SIZE), b''):
+                    lines += chunk.count(b'\n')
+                    last = chunk[-1:]
+            if last != b'\n':
+                lines += 1
+            self._length = max(0, lines - 1)
+        return self._length
+
+    def __iter__(self):
+        for recipient in self.recipients():
+            yield recipient.address
+
+    def recipients(self):
+        '''
+        yields a Recipient for each row worth sending to,
+        reading the file as it goes
+        (what was dropped is counted in report afterwards)
+        '''
+        cleaner = RecipientCleaner()
+        self._cleaner = cleaner
+        yield from cleaner.clean(self._rows())
+
+    @property
+    def report(self):
+        '''
+        CleanReport of the last time the recipients were read
+        '''
+        return self._cleaner.report
+
+    def _rows(self):
+        '''
+        yields a Recipient for each row in the file
+        '''
+        with self._open() as f:
+            reader = csv.reader(f, delimiter=self.delimiter)
+            next(reader, None)
+            email_index = self.columns.index(self.email_column)
+            field_indexes = [(name, self.columns.index(column))
+                             for name, column in self.fields.items()]
+            for row in reader:
+                address = row[email_index] if email_index < len(row) else ''
+                fields = {name: row[i] if i < len(row) else ''
+                          for name, i in field_indexes}
+                yield Recipient(address, fields)
@@ -0,0 +1,365 @@
+# for the campaign scheduler
+import json
+import math
+import sqlite3
+import threading
+import time
+from collections import deque, namedtuple
+
+from attachments import Attachment
+from gmail import Message
+from journal import campaign_id
+from recipients import RecipientFile, RecipientList
+
+
+# how many messages gmail lets an account send a day
+# (it is 2,000 for a google workspace account)
+DAILY_LIMIT = 500
+
+DAY = 24 * 60 * 60
+
+
+class DailyPacer:
+    '''
+    Spreads sends out so an account stays under its daily
+    sending limit, instead of sending flat out until gmail
+    refuses and failing the rest of the list.
+
+    No more than daily_limit messages are ever sent in any
+    24 hours. A campaign that fits in what is left of today's
+    limit (see expect) goes straight out. Otherwise a burst of
+    sends can go straight away, and after the burst they are
+    spaced evenly through the day, so a big list drains
+    steadily (e.g. overnight).
+
+    Sends from earlier runs (e.g. from the journal) can be
+    given as history so the limit holds across restarts.
+    Safe to share between sender threads
+    '''
+
+    def __init__(self, daily_limit:int=DAILY_LIMIT, burst:int=None, history=()):
+        '''
+        :param daily_limit: most messages to send in any 24 hours
+        :param burst: most messages to send at once before spacing
+                      them out (a tenth of the daily limit if not given)
+        :param history: time.time() of each message already sent
+                        in the last day
+        '''
+        self.daily_limit = max(1, daily_limit)
+        self.burst = max(1, burst or self.daily_limit // 10)
+        self.rate = self.daily_limit / DAY
+
+        now = time.time()
+        self._sent = deque(at for at in sorted(history) if at > now - DAY)
+        self._tokens = min(self.burst, self.daily_limit - len(self._sent))
+        self._last = now
+        # sends that can go without waiting for the burst to refill
+        self._expected = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def sent_today(self):
+        '''
+        the number of messages sent in the last 24 hours
+        '''
+        with self._lock:
+            self._expire(time.time())
+            return len(self._sent)
+
+    def _expire(self, now):
+        '''
+        forgets sends more than a day old (call while holding the lock)
+        '''
+        sent = self._sent
+        while sent and sent[0] <= now - DAY:
+            sent.popleft()
+
+    def remaining(self):
+        '''
+        the number of messages that can still be
+        sent before the daily limit is reached
+        '''
+        return self.daily_limit - self.sent_today()
+
+    def expect(self, count:int):
+        '''
+        notes that a campaign of count messages is starting.
+        if they fit in what is left of the daily limit they
+        can all go straight away, rather than being spaced out
+        '''
+        with self._lock:
+            self._expire(time.time())
+            fits = len(self._sent) + count <= self.daily_limit
+            self._expected = count if fits else 0
+
+    def delay(self, count:int=1):
+        '''
+        :return: seconds until count more messages can be sent
+                 (inf if they can never all go at once, as there
+                 are more than a burst, or than the daily limit)
+        '''
+        return self._delay(count, whole=False)
+
+    def _delay(self, count, whole):
+        '''
+        :param whole: let count go as a whole even if it is more than
+                      a burst or the daily limit (e.g. one big bcc'd
+                      message), once a full burst and day are free
+        '''
+        if count > self.daily_limit:
+            if not whole:
+                return math.inf
+            count = self.daily_limit
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            # waiting for the burst allowance to refill
+            # (for any sends the campaign wasn't expected to have)
+            paced = count - min(count, self._expected)
+            if paced > self.burst:
+                if not whole:
+                    return math.inf
+                paced = self.burst
+            wait = max(0, (paced - tokens) / self.rate) if paced else 0
+            # and for enough of the last day's sends to be a day old
+            over = len(self._sent) + count - self.daily_limit
+            if over > 0:
+                wait = max(wait, self._sent[over - 1] + DAY - now)
+            return wait
+
+    def take(self, count:int=1):
+        '''
+        notes that count messages are being sent now
+        '''
+        count = min(count, self.daily_limit)
+        with self._lock:
+            now = time.time()
+            expected = min(count, self._expected)
+            self._expected -= expected
+            self._tokens = (min(self.burst, self._tokens + (now - self._last) * self.rate)
+                            - (count - expected))
+            self._last = now
+            self._sent.extend([now] * count)
+
+    def wait(self, count:int=1):
+        '''
+        blocks until count more messages can be sent,
+        and counts them as sent
+        :return: False if the pacer was stopped while waiting
+        '''
+        while not self._stop.is_set():
+            wait = self._delay(count, whole=True)
+            if wait <= 0:
+                self.take(count)
+                return True
+            # waits in short steps, as other threads could take the sends first
+            self._stop.wait(min(wait, 60))
+        return False
+
+    def stop(self):
+        '''
+        stops everything waiting to send (e.g. the app is closing)
+        '''
+        self._stop.set()
+
+    @property
+    def stopped(self):
+        return self._stop.is_set()
+
+
+# a campaign waiting in (or taken from) the queue
+# spec is what the message and contacts were made from
+QueuedCampaign = namedtuple('QueuedCampaign', [
+    'id', 'campaign', 'name', 'priority', 'start_at', 'status',
+    'spec', 'contacts', 'created', 'detail'])
+
+
+def campaign_spec(message, contacts, bcc_size:int=None, resend:bool=False):
+    '''
+    what is needed to make the campaign again later, ready for json
+    :param message: gmail.Message
+    :param contacts: RecipientList or RecipientFile
+    :param resend: send to everyone, even those the message
+                   was sent to before it was queued
+    '''
+    spec = {
+        'sender': message.sender,
+        'subject': message.subject,
+        'body': message.body,
+        'body_type': message.body_type,
+        'attachments': [{'path': attachment.path, 'filename': attachment.filename,
+                         'content_type': attachment.content_type}
+                        for attachment in message.attachments],
+        'bcc_size': bcc_size,
+        'resend': resend,
+        }
+    if isinstance(contacts, RecipientFile):
+        spec['contacts_file'] = {'path': contacts.path, 'email_column': contacts.email_column,
+                                 'fields': contacts.fields, 'delimiter': contacts.delimiter,
+                                 'encoding': contacts.encoding}
+    return spec
+
+
+def skip_for(queued:QueuedCampaign, journal):
+    '''
+    the addresses a queued campaign doesn't need to send to:
+    everyone its message was sent to, or if it was queued
+    to be resent, everyone sent to since it was queued
+    :param journal: journal.SendJournal of the campaign
+    '''
+    return journal.completed(since=queued.created if queued.spec.get('resend') else 0)
+
+
+def load_campaign(queued:QueuedCampaign):
+    '''
+    makes a queued campaign's message and contacts again
+    :return: (gmail.Message, RecipientList or RecipientFile)
+    '''
+    spec = queued.spec
+    message = Message()
+    message.create(to='', sender=spec['sender'], subject=spec['subject'],
+                   body=spec['body'], body_type=spec['body_type'],
+                   attachments=[Attachment(a['path'], a['filename'], a['content_type'])
+                                for a in spec['attachments']])
+    contacts_file = spec.get('contacts_file')
+    if contacts_file is not None:
+        contacts = RecipientFile(contacts_file['path'], contacts_file['email_column'],
+                                 contacts_file['fields'], contacts_file['delimiter'],
+                                 contacts_file['encoding'])
+    else:
+        contacts = RecipientList(queued.contacts or '')
+    return message, contacts
+
+
+class CampaignQueue:
+    '''
+    Campaigns waiting to be sent, kept in a sqlite database
+    (by default the journal's) so they survive a restart.
+
+    The next campaign is the one interrupted last time if
+    there is one, then the highest priority one whose start
+    time has come, then the one queued first
+    '''
+
+    QUEUED = 'queued'
+    SENDING = 'sending'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, db_path:str='journal.sqlite3'):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS campaigns ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'campaign TEXT NOT NULL, '
+            'name TEXT, '
+            'priority INTEGER NOT NULL, '
+            'start_at REAL NOT NULL, '
+            'status TEXT NOT NULL, '
+            'spec TEXT NOT NULL, '
+            'contacts TEXT, '
+            'created REAL NOT NULL, '
+            'detail TEXT)')
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS campaigns_status '
+            'ON campaigns (status, priority, start_at)')
+        self._db.commit()
+
+    def _rows(self, where, args=(), order='', limit=None):
+        sql = (f'SELECT id, campaign, name, priority, start_at, status, spec, contacts, '
+               f'created, detail FROM campaigns WHERE {where} {order}')
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+        with self._lock:
+            rows = self._db.execute(sql, args).fetchall()
+        return [QueuedCampaign(*row[:6], json.loads(row[6]), *row[7:]) for row in rows]
+
+    def add(self, message, contacts, priority:int=0, start_at:float=None,
+            bcc_size:int=None, resend:bool=False):
+        '''
+        queues a campaign. contacts typed into the gui are saved
+        with it, a contacts file is read again when it is sent
+        :param priority: higher goes first
+        :param start_at: time.time() to send it from (now if not given)
+        :return: the QueuedCampaign
+        '''
+        spec = campaign_spec(message, contacts, bcc_size, resend)
+        text = None if 'contacts_file' in spec else '\n'.join(contacts)
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                'INSERT INTO campaigns (campaign, name, priority, start_at, status, spec, '
+                'contacts, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (campaign_id(message), message.subject, priority,
+                 now if start_at is None else start_at, self.QUEUED,
+                 json.dumps(spec), text, now))
+            self._db.commit()
+            id = cursor.lastrowid
+        return self.get(id)
+
+    def get(self, id:int):
+        rows = self._rows('id = ?', (id,))
+        return rows[0] if rows else None
+
+    def next_due(self, now:float=None):
+        '''
+        :return: the QueuedCampaign to send next, or None
+                 if none are due to start yet
+        '''
+        now = time.time() if now is None else now
+        rows = self._rows('status = ? OR (status = ? AND start_at <= ?)',
+                          (self.SENDING, self.QUEUED, now),
+                          'ORDER BY status = \'sending\' DESC, priority DESC, start_at, id', 1)
+        return rows[0] if rows else None
+
+    def waiting(self):
+        '''
+        every campaign not yet sent, in the order they will go
+        '''
+        return self._rows('status IN (?, ?)', (self.SENDING, self.QUEUED, time.time()),
+                          'ORDER BY status = \'sending\' DESC, start_at > ?, '
+                          'priority DESC, start_at, id')
+
+    def next_start(self):
+        '''
+        the time.time() the next campaign is due to start, or None
+        '''
+        with self._lock:
+            (start_at,) = self._db.execute(
+                'SELECT MIN(start_at) FROM campaigns WHERE status = ?',
+                (self.QUEUED,)).fetchone()
+        return start_at
+
+    def set_status(self, id:int, status:str, detail:str=None, start_at:float=None):
+        '''
+        :param start_at: when to try again, if it goes back on the queue
+        '''
+        with self._lock:
+            if start_at is None:
+                self._db.execute('UPDATE campaigns SET status = ?, detail = ? WHERE id = ?',
+                                 (status, detail, id))
+            else:
+                self._db.execute(
+                    'UPDATE campaigns SET status = ?, detail = ?, start_at = ? WHERE id = ?',
+                    (status, detail, start_at, id))
+            self._db.commit()
+
+    def cancel_waiting(self):
+        '''
+        cancels every campaign that hasn't started sending
+        :return: how many were cancelled
+        '''
+        with self._lock:
+            cursor = self._db.execute('UPDATE campaigns SET status = ? WHERE status = ?',
+                                      (self.CANCELLED, self.QUEUED))
+            self._db.commit()
+            return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._db.close()
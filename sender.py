@@ -0,0 +1,471 @@
+# for the sender pool
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
+from gmail import Emailer
+from metrics import SEND_QUEUE, count_send
+from ratelimit import QuotaLimiter, is_daily_limit_error
+
+
+def chunks(iterable, size):
+    '''
+    splits an iterable into lists of (at most) size items
+    without reading the whole iterable into memory
+    '''
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def envelope_size(envelope):
+    '''
+    the bytes of the envelope's (base64 encoded) message
+    '''
+    return len(envelope.message['raw'])
+
+
+def recipient_count(envelope):
+    '''
+    how many people the envelope goes to
+    (a bcc'd message counts once per address)
+    '''
+    return 1 if envelope.bcc is None else len(envelope.bcc)
+
+
+class SenderPool:
+    '''
+    Sends envelopes from several threads at once.
+
+    Each thread owns its own Emailer, built from
+    its own gmail service, because the httplib2
+    connection underneath a service is not thread safe.
+
+    Only a couple of chunks per thread are queued up, and no
+    more than max_queued_bytes of messages, so big messages
+    (e.g. with attachments) don't pile up in memory. A batch
+    is also cut short at max_batch_bytes, so each batched
+    request stays a sensible size.
+
+    With a pacer, each chunk waits for it as it is handed to
+    a thread, and a chunk is sent as it is rather than waiting
+    to fill up, so every message goes as soon as the pacer lets it
+    '''
+
+    # most bytes of messages in one batched request
+    MAX_BATCH_BYTES = 8 << 20
+
+    # most bytes of messages queued up or being sent at once
+    MAX_QUEUED_BYTES = 64 << 20
+
+    def __init__(self, service_factory, workers:int=4, batch_size:int=1,
+                 limiter:QuotaLimiter=None, max_batch_bytes:int=MAX_BATCH_BYTES,
+                 max_queued_bytes:int=MAX_QUEUED_BYTES, pacer=None):
+        '''
+        :param service_factory: callable that makes a new gmail service
+                                (e.g. Authenicator.build_service)
+        :param workers: number of sender threads
+        :param batch_size: envelopes per batched http request
+                           (1 sends each envelope with its own request)
+        :param limiter: quota limiter shared by all the threads
+        :param max_batch_bytes: most bytes of messages per batched request
+        :param max_queued_bytes: most bytes of messages queued up or
+                                 being sent at once (a single chunk
+                                 bigger than this is still sent)
+        :param pacer: what keeps the sends under the account's daily limit,
+                      anything with delay(count) and wait(count) like
+                      scheduler.DailyPacer's. sending stops early if
+                      wait returns False
+        '''
+        self.service_factory = service_factory
+        self.workers = max(1, workers)
+        self.batch_size = max(1, min(batch_size, Emailer.BATCH_LIMIT))
+        self.limiter = limiter
+        self.max_batch_bytes = max_batch_bytes
+        self.max_queued_bytes = max_queued_bytes
+        self.pacer = pacer
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+
+    def _emailer(self):
+        '''
+        the emailer belonging to the current thread
+        (made the first time the thread asks for it)
+        '''
+        emailer = getattr(self._local, 'emailer', None)
+        if emailer is None:
+            emailer = Emailer(self.service_factory(), limiter=self.limiter)
+            self._local.emailer = emailer
+        return emailer
+
+    def _send_chunk(self, envelopes, callback):
+        '''
+        sends a chunk of envelopes from a worker thread
+        '''
+        def _report(envelope, sent, result):
+            with self._lock:
+                if sent:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+            callback(envelope, sent, result)
+
+        try:
+            emailer = self._emailer()
+            if len(envelopes) == 1:
+                sent, result = emailer.send(envelopes[0])
+                _report(envelopes[0], sent, result)
+            else:
+                emailer.send_batch(envelopes, _report)
+        except Exception as e:
+            # anything other than an http error (e.g. a dropped connection)
+            # would otherwise vanish inside the thread pool
+            print('An error occurred: {}'.format(e))
+            for envelope in envelopes:
+                count_send(e)
+                _report(envelope, False, e)
+
+    def run(self, envelopes, callback):
+        '''
+        sends every envelope, blocking until they are all done
+
+        :param envelopes: iterable of Envelope. it is read lazily
+                          so it can be a generator
+        :param callback: called as callback(envelope, sent, sent_msg_or_error)
+                         from the worker threads as each envelope finishes
+        :return: (number sent, number failed)
+        '''
+        self.sent = 0
+        self.failed = 0
+
+        # only keep a couple of chunks queued up per thread so
+        # a huge list of envelopes isn't all made up front
+        slots = threading.BoundedSemaphore(self.workers * 2)
+        # and only so many bytes of them
+        queued = threading.Condition()
+        queued_bytes = 0
+
+        def _release(future):
+            nonlocal queued_bytes
+            SEND_QUEUE.dec(future.size)
+            with queued:
+                queued_bytes -= future.bytes
+                queued.notify_all()
+            slots.release()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for chunk, size, recipients in self._chunks(envelopes):
+                if self.pacer is not None and not self.pacer.wait(recipients):
+                    break
+                slots.acquire()
+                with queued:
+                    queued.wait_for(lambda: queued_bytes == 0
+                                    or queued_bytes + size <= self.max_queued_bytes)
+                    queued_bytes += size
+                SEND_QUEUE.inc(len(chunk))
+                future = executor.submit(self._send_chunk, chunk, callback)
+                future.size = len(chunk)
+                future.bytes = size
+                future.add_done_callback(_release)
+
+        return self.sent, self.failed
+
+    def _chunks(self, envelopes):
+        '''
+        splits the envelopes into chunks of at most batch_size,
+        cut short at max_batch_bytes, or as soon as the pacer
+        wouldn't let the next envelope go with the rest
+        (so a chunk is never held back waiting to fill up)
+        :return: iterator of (list of envelopes, their bytes, their recipients)
+        '''
+        pacer = self.pacer
+        chunk = []
+        size = 0
+        recipients = 0
+        for envelope in envelopes:
+            envelope_bytes = envelope_size(envelope)
+            count = recipient_count(envelope)
+            if chunk and (size + envelope_bytes > self.max_batch_bytes or (
+                    pacer is not None and pacer.delay(recipients + count) > 0)):
+                yield chunk, size, recipients
+                chunk = []
+                size = 0
+                recipients = 0
+            chunk.append(envelope)
+            size += envelope_bytes
+            recipients += count
+            if len(chunk) == self.batch_size:
+                yield chunk, size, recipients
+                chunk = []
+                size = 0
+                recipients = 0
+        if chunk:
+            yield chunk, size, recipients
+
+
+class Account:
+    '''
+    One gmail account sending part of a campaign.
+    It has its own sender, and so its own services
+    and quota limiter
+    '''
+
+    def __init__(self, name:str, sender):
+        '''
+        :param name: to know the account by (e.g. its email address)
+        :param sender: what sends from this account, e.g. a SenderPool
+                       or aiosender.AsyncEmailer
+        '''
+        self.name = name
+        self.sender = sender
+        self.sent = 0
+        self.failed = 0
+        # the error once the account hits its daily limit
+        self.exhausted = None
+
+    def __str__(self):
+        text = f'{self.name}: {self.sent} sent, {self.failed} failed'
+        if self.exhausted is not None:
+            text += ' (hit its daily sending limit)'
+        return text
+
+
+class ShardedSender:
+    '''
+    Sends from several gmail accounts at once, to get
+    past a single account's rate and daily limits.
+
+    Every account takes envelopes from the same queue as it
+    is ready for them, so a quicker account sends more. When
+    an account hits its daily limit it stops, and whatever it
+    was sending goes back on the queue for the others. Only
+    once every account has hit its limit do sends fail
+    '''
+
+    def __init__(self, accounts):
+        '''
+        :param accounts: list of Account
+        '''
+        self.accounts = list(accounts)
+        if not self.accounts:
+            raise ValueError('Need at least one account to send from')
+        self._lock = threading.Lock()
+        self._returned = deque()
+
+    def _envelopes(self, source, account):
+        '''
+        yields the envelopes for one account, sent back
+        ones first, until the queue is empty or the
+        account hits its daily limit
+        '''
+        while account.exhausted is None:
+            with self._lock:
+                if self._returned:
+                    envelope = self._returned.popleft()
+                else:
+                    envelope = next(source, None)
+            if envelope is None:
+                return
+            yield envelope
+
+    def _callback(self, account, callback):
+        '''
+        the callback for one account, which puts envelopes
+        back on the queue when the account hits its daily limit
+        '''
+        def _report(envelope, sent, result):
+            if not sent and is_daily_limit_error(result):
+                with self._lock:
+                    if account.exhausted is None:
+                        print(f'{account.name} hit its daily sending limit')
+                    account.exhausted = result
+                    self._returned.append(envelope)
+                return
+            with self._lock:
+                if sent:
+                    account.sent += 1
+                else:
+                    account.failed += 1
+            callback(envelope, sent, result)
+        return _report
+
+    def run(self, envelopes, callback):
+        '''
+        sends every envelope from all the accounts in parallel,
+        blocking until they are all done. this is the same as
+        SenderPool.run, so it can be used in its place
+
+        :param envelopes: iterable of Envelope, read lazily
+        :param callback: called as callback(envelope, sent, sent_msg_or_error)
+                         as each envelope finishes, from any account
+        :return: (number sent, number failed)
+        '''
+        source = iter(envelopes)
+        self._returned = deque()
+        for account in self.accounts:
+            account.sent = account.failed = 0
+            account.exhausted = None
+
+        errors = []
+
+        def _run(account):
+            try:
+                account.sender.run(self._envelopes(source, account),
+                                   self._callback(account, callback))
+            except Exception as e:
+                errors.append(e)
+
+        # go round again if an account hit its limit after the
+        # others ran out of work, so what it sent back still goes
+        while True:
+            active = [account for account in self.accounts if account.exhausted is None]
+            if not active:
+                break
+            threads = [threading.Thread(target=_run, args=(account,),
+                                        name=f'Account {account.name}')
+                       for account in active]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise errors[0]
+            if not self._returned:
+                break
+
+        sent = sum(account.sent for account in self.accounts)
+        failed = sum(account.failed for account in self.accounts)
+
+        # every account is out of sends for today
+        if not active:
+            error = self.accounts[-1].exhausted
+            leftover = list(self._returned)
+            self._returned.clear()
+            for envelope in chain(leftover, source):
+                count_send(error)
+                callback(envelope, False, error)
+                failed += 1
+        return sent, failed
+
+
+def count_unsent(contacts, skip=frozenset()):
+    '''
+    the number of contacts there are to send to, less any skipped.
+    for a contacts file this reads it all, as its length only
+    counts its lines (with the headings, blank, invalid and
+    repeated rows)
+    :param skip: (lower case) addresses already sent to
+    '''
+    return sum(1 for recipient in contacts.recipients()
+               if recipient.address.lower() not in skip)
+
+
+class CampaignReport(namedtuple('CampaignReport', ['sent', 'failed', 'skipped', 'contacts'])):
+    '''
+    counts of how a campaign went
+    (contacts is the recipients' CleanReport)
+    '''
+
+    def __str__(self):
+        return (f'{self.sent} sent, {self.failed} failed, '
+                f'{self.skipped} already sent. {self.contacts}')
+
+
+def send_campaign(message, contacts, service_factory, callback, skipped_callback=None,
+                  batch_size:int=1, workers:int=1, limiter:QuotaLimiter=None,
+                  journal=None, skip=frozenset(), sender=None, bcc_size:int=None,
+                  prerenderer=None, pacer=None):
+    '''
+    sends the message to each of the contacts
+    (this is everything a send does, minus the gui)
+
+    :param message: gmail.Message to send
+    :param contacts: RecipientList or RecipientFile
+    :param service_factory: callable that makes a new gmail service
+    :param callback: called as callback(envelope, sent, sent_msg_or_error)
+                     from the sender threads as each message finishes
+    :param skipped_callback: called as skipped_callback(recipient)
+                             for each contact skipped
+    :param batch_size: messages per batched http request
+    :param workers: number of sender threads
+    :param limiter: quota limiter for the account
+    :param journal: journal.SendJournal to record each send in
+    :param skip: (lower case) addresses already sent to
+    :param sender: what does the sending, anything with a
+                   run(envelopes, callback) like SenderPool's
+                   (e.g. aiosender.AsyncEmailer). by default it is a
+                   SenderPool made from the arguments above
+    :param bcc_size: if given, send one message to each group of this
+                     many contacts on its bcc line (at most Message.BCC_LIMIT)
+                     rather than one each. the message can't have merge fields.
+                     every contact in a group is reported with the group's result
+    :param prerenderer: what renders the messages ahead of the senders, anything
+                        with an envelopes(recipients) like prerender.Prerenderer's.
+                        by default they are rendered as the senders ask for them
+    :param pacer: what keeps the sends under the account's daily limit, anything
+                  with expect(count) and wait(count) like scheduler.DailyPacer's.
+                  it is told how many messages to expect, and handed to the
+                  SenderPool made here (a sender given in is made with it)
+    :return: CampaignReport of what was sent
+    '''
+    if bcc_size:
+        message.template().check_bcc()
+
+    counts = {True: 0, False: 0}
+    lock = threading.Lock()
+
+    def _report_one(envelope, sent, result):
+        with lock:
+            counts[sent] += 1
+        if journal is not None:
+            journal.record(envelope.to, sent, None if sent else str(result))
+        callback(envelope, sent, result)
+
+    def _report(envelope, sent, result):
+        if envelope.bcc is None:
+            _report_one(envelope, sent, result)
+            return
+        # the one result goes for everyone the message was bcc'd to
+        for address in envelope.bcc:
+            _report_one(envelope._replace(to=address, bcc=None), sent, result)
+
+    skipped = 0
+
+    def _unsent(recipients):
+        nonlocal skipped
+        for recipient in recipients:
+            if recipient.address.lower() in skip:
+                skipped += 1
+                if skipped_callback is not None:
+                    skipped_callback(recipient)
+            else:
+                yield recipient
+
+    recipients = _unsent(contacts.recipients())
+    if bcc_size:
+        envelopes = (message.bcc_envelope(recipient.address for recipient in group)
+                     for group in chunks(recipients, min(bcc_size, message.BCC_LIMIT)))
+    elif prerenderer is not None:
+        envelopes = prerenderer.envelopes(recipients)
+    else:
+        envelopes = (message.envelope(recipient.address, recipient.fields)
+                     for recipient in recipients)
+    if pacer is not None:
+        pacer.expect(count_unsent(contacts, skip))
+    if sender is None:
+        sender = SenderPool(service_factory, workers=workers,
+                            batch_size=batch_size, limiter=limiter, pacer=pacer)
+    try:
+        sender.run(envelopes, _report)
+    finally:
+        if journal is not None:
+            journal.close()
+    return CampaignReport(counts[True], counts[False], skipped, contacts.report)